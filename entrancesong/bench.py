@@ -0,0 +1,404 @@
+"""Offline benchmark for the arrival path.
+
+Feeds DHCP packets from a pcap file, or made-up bursts of them, through the controller
+against a throwaway database and an in-process stand-in for Spotify, then reports
+throughput, how long each stage took and how deep the queues got.
+
+"""
+import argparse
+from collections import Counter
+from threading import Lock, Thread
+import threading
+from time import monotonic, sleep
+import logging
+import os
+import random
+import shutil
+import struct
+import tempfile
+
+from . import data
+from .capture import DHCP_DISCOVER, DHCP_REQUEST, parse_dhcp_frame, MAGIC_COOKIE
+from .metrics import StageTimes
+from .models import Base, Device, Owner, Song
+
+STUB_DEVICE_ID = 'stub-device'
+
+
+class StubSpotify(object):
+    """Stands in for spotipy.Spotify with just the calls the player makes. Tracks a little
+    playback state, counts calls and can add latency to each one.
+    """
+    def __init__(self, latency=0.0):
+        """Constructor
+        Args
+            latency - Seconds each call takes
+        """
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = Lock()
+        self.playback = {
+            'device': {'id': STUB_DEVICE_ID, 'name': 'Stub', 'type': 'Computer', 'is_active': True,
+                       'volume_percent': 50},
+            'is_playing': True,
+            'progress_ms': 60000,
+            'context': {'type': 'album', 'uri': 'spotify:album:stub'},
+            'item': {'uri': 'spotify:track:stub1', 'name': 'Background', 'track_number': 1,
+                     'album': {'uri': 'spotify:album:stub'}},
+        }
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            sleep(self.latency)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def search(self, q, limit=10, **kwargs):
+        self._call('search')
+        uri = 'spotify:track:{:016x}'.format(abs(hash(q)))
+        return {'tracks': {'items': [{'uri': uri, 'name': q, 'duration_ms': 240000}]}}
+
+    def tracks(self, tracks):
+        self._call('tracks')
+        return {'tracks': [{'uri': uri, 'duration_ms': 240000} for uri in tracks]}
+
+    def devices(self):
+        self._call('devices')
+        return {'devices': [dict(self.playback['device'])]}
+
+    def current_playback(self):
+        self._call('current_playback')
+        return dict(self.playback)
+
+    def currently_playing(self):
+        self._call('currently_playing')
+        return dict(self.playback)
+
+    def start_playback(self, device_id=None, context_uri=None, uris=None, offset=None, position_ms=None):
+        self._call('start_playback')
+        self.playback['is_playing'] = True
+        self.playback['progress_ms'] = position_ms or 0
+        if uris:
+            self.playback['item'] = dict(self.playback['item'], uri=uris[0])
+        if context_uri:
+            self.playback['context'] = {'type': 'album', 'uri': context_uri}
+
+    def pause_playback(self, device_id=None):
+        self._call('pause_playback')
+        self.playback['is_playing'] = False
+
+    def volume(self, volume_percent, device_id=None):
+        self._call('volume')
+        self.playback['device'] = dict(self.playback['device'], volume_percent=volume_percent)
+
+    def transfer_playback(self, device_id, force_play=True):
+        self._call('transfer_playback')
+
+    def next_track(self, device_id=None):
+        self._call('next_track')
+
+    def seek_track(self, position_ms, device_id=None):
+        self._call('seek_track')
+        self.playback['progress_ms'] = position_ms
+
+    def album_tracks(self, album_id, limit=50, offset=0):
+        self._call('album_tracks')
+        return {'items': [{'uri': 'spotify:track:stub{}'.format(i)} for i in range(1, 13)], 'next': None}
+
+    def next(self, result):
+        self._call('next')
+        return None
+
+
+def build_dhcp_frame(mac_addr, message_type=DHCP_REQUEST, hostname=None, requested_addr=None):
+    """Builds an Ethernet frame holding a DHCP packet from a client
+
+    Args:
+        mac_addr - The client's MAC address, colon separated
+        message_type - The DHCP message type (option 53)
+        hostname - The hostname option, if any
+        requested_addr - The requested IP address option, if any
+
+    Returns the frame as bytes
+    """
+    mac = bytes(int(b, 16) for b in mac_addr.split(':'))
+    options = bytes([53, 1, message_type])
+    if requested_addr:
+        options += bytes([50, 4]) + bytes(int(b) for b in requested_addr.split('.'))
+    if hostname:
+        name = hostname.encode('utf-8')[:255]
+        options += bytes([12, len(name)]) + name
+    options += b'\xff'
+
+    bootp = struct.pack('!BBBBIHH4s4s4s4s16s64s128s', 1, 1, 6, 0, random.getrandbits(32), 0, 0x8000,
+                        bytes(4), bytes(4), bytes(4), bytes(4), mac, bytes(64), bytes(128))
+    payload = bootp + MAGIC_COOKIE + options
+    udp = struct.pack('!HHHH', 68, 67, 8 + len(payload), 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp) + len(payload), 0, 0, 64, 17, 0,
+                     bytes(4), b'\xff\xff\xff\xff')
+    ether = b'\xff' * 6 + mac + b'\x08\x00'
+    return ether + ip + udp + payload
+
+
+def synthetic_macs(count):
+    """Makes up count MAC addresses"""
+    return ['02:00:{:02x}:{:02x}:{:02x}:{:02x}'.format((i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            for i in range(count)]
+
+
+def synthetic_frames(macs, packets, retries=3, discover_ratio=0.25):
+    """Generates bursts of DHCP traffic the way clients joining a network send it: an
+    optional DISCOVER followed by a few REQUEST retries.
+
+    Args:
+        macs - The MAC addresses to send from
+        packets - How many frames to generate in total
+        retries - How many REQUESTs each client sends per join
+        discover_ratio - How often a join starts with a DISCOVER
+    """
+    sent = 0
+    while sent < packets:
+        mac = random.choice(macs)
+        burst = []
+        if random.random() < discover_ratio:
+            burst.append(DHCP_DISCOVER)
+        burst.extend([DHCP_REQUEST] * retries)
+        for message_type in burst:
+            if sent >= packets:
+                return
+            yield build_dhcp_frame(mac, message_type, hostname='bench-' + mac[-5:].replace(':', ''),
+                                   requested_addr='10.0.{}.{}'.format(random.randint(0, 255), random.randint(1, 254)))
+            sent += 1
+
+
+def read_pcap(path):
+    """Reads the frames out of a classic pcap file of Ethernet traffic"""
+    with open(path, 'rb') as f:
+        header = f.read(24)
+        if len(header) < 24:
+            raise ValueError('{} is too short to be a pcap file'.format(path))
+        magic = header[:4]
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            endian = '<'
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            endian = '>'
+        else:
+            raise ValueError('{} is not a pcap file (pcapng isn\'t supported)'.format(path))
+        linktype = struct.unpack(endian + 'I', header[20:24])[0]
+        if linktype != 1:
+            raise ValueError('{} has link type {}, only Ethernet (1) is supported'.format(path, linktype))
+
+        while True:
+            record = f.read(16)
+            if len(record) < 16:
+                return
+            _, _, caplen, _ = struct.unpack(endian + 'IIII', record)
+            frame = f.read(caplen)
+            if len(frame) < caplen:
+                return
+            yield frame
+
+
+def populate(session, macs, known=0.9, clip_seconds=0):
+    """Adds an owner with one song for a fraction of the MAC addresses"""
+    for i, mac in enumerate(macs):
+        if random.random() >= known:
+            continue
+        owner = Owner(name='bench owner {}'.format(i))
+        owner.song = [Song(artist='Artist {}'.format(i % 97), title='Title {}'.format(i),
+                           start_minutes=0, start_seconds=0, duration=clip_seconds)]
+        session.add(owner)
+        session.add(Device(mac_address=mac, hostname='bench', friendly_name='bench device', owner=owner))
+    session.commit()
+
+
+def instrument(controller, times):
+    """Wraps the controller's stages to time them"""
+    submitted = {}
+
+    original_submit = controller.resolvers.submit
+    original_handler = controller.resolvers.handler
+    original_queue_song = controller.player.queue_song
+
+    def submit(request):
+        submitted[id(request)] = monotonic()
+        return original_submit(request)
+
+    def handler(request):
+        started = monotonic()
+        queued_at = submitted.pop(id(request), None)
+        if queued_at is not None:
+            times.record('queue_wait', started - queued_at)
+        try:
+            return original_handler(request)
+        finally:
+            times.record('resolve', monotonic() - started)
+
+    def queue_song(*args, **kwargs):
+        arrival = kwargs.get('arrival')
+        if arrival:
+            # Counted once the music has actually started, not when the player picks it up
+            queued_at = monotonic()
+            on_finish = arrival.on_finish
+
+            def finished(latency):
+                times.record('player_wait', monotonic() - queued_at)
+                if on_finish:
+                    on_finish(latency)
+            arrival.on_finish = finished
+        return original_queue_song(*args, **kwargs)
+
+    controller.resolvers.submit = submit
+    controller.resolvers.handler = handler
+    controller.player.queue_song = queue_song
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING, format='[%(asctime)s %(levelname)s] %(message)s',
+                        datefmt='%Y %b %d %H:%M:%S')
+
+    parser = argparse.ArgumentParser(description='Benchmarks the arrival path offline')
+    parser.add_argument('--pcap', dest='pcap', action='store', default=None,
+                        help='Replay this pcap file instead of generating traffic')
+    parser.add_argument('--macs', dest='macs', action='store', default=200, type=int,
+                        help='How many devices to generate traffic for')
+    parser.add_argument('--packets', dest='packets', action='store', default=5000, type=int)
+    parser.add_argument('--retries', dest='retries', action='store', default=3, type=int,
+                        help='DHCP REQUESTs per join')
+    parser.add_argument('--known', dest='known', action='store', default=0.9, type=float,
+                        help='Fraction of devices that are in the database')
+    parser.add_argument('--rate', dest='rate', action='store', default=0, type=float,
+                        help='Packets per second to send, or 0 for as fast as possible')
+    parser.add_argument('--capture', dest='capture', action='store', default='scapy', choices=['scapy', 'raw'],
+                        help='Which capture path to feed packets through')
+    parser.add_argument('--api-latency', dest='api_latency', action='store', default=0.05, type=float,
+                        help='Seconds each stub Spotify call takes')
+    parser.add_argument('--clip-seconds', dest='clip_seconds', action='store', default=0, type=int)
+    parser.add_argument('--workers', dest='workers', action='store', default=2, type=int)
+    parser.add_argument('--coalesce', dest='coalesce_window', action='store', default=None, type=float)
+    parser.add_argument('--owner-cooldown', dest='owner_cooldown', action='store', default=30, type=float)
+    parser.add_argument('--drain-timeout', dest='drain_timeout', action='store', default=60, type=float,
+                        help='Seconds to wait for queued songs to play after the last packet')
+    parser.add_argument('--seed', dest='seed', action='store', default=1, type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    from .entrance import EntranceController
+
+    # A thread dying (like the player on a bad song) means the numbers can't be trusted
+    thread_errors = []
+    default_excepthook = threading.excepthook
+
+    def excepthook(hook_args):
+        thread_errors.append(hook_args.thread.name if hook_args.thread else '?')
+        default_excepthook(hook_args)
+    threading.excepthook = excepthook
+
+    failed = False
+    workdir = tempfile.mkdtemp(prefix='entrancesong-bench-')
+    try:
+        data.configure('sqlite:///' + os.path.join(workdir, 'bench.db'))
+        Base.metadata.create_all(data.get_engine())
+
+        if args.pcap:
+            frames = list(read_pcap(args.pcap))
+            macs = sorted({data.normalize_mac('%02x:%02x:%02x:%02x:%02x:%02x' % tuple(f[6:12]))
+                           for f in frames if len(f) >= 12})
+        else:
+            macs = synthetic_macs(args.macs)
+            frames = list(synthetic_frames(macs, args.packets, retries=args.retries))
+
+        session = data.Session()
+        populate(session, macs, known=args.known, clip_seconds=args.clip_seconds)
+        session.close()
+
+        stub = StubSpotify(latency=args.api_latency)
+        controller = EntranceController(capture=args.capture, workers=args.workers, prewarm=False, fade_duration=0,
+                                        coalesce_window=args.coalesce_window, owner_cooldown=args.owner_cooldown,
+                                        spotify_client=stub)
+        times = StageTimes()
+        instrument(controller, times)
+        controller.start_processing()
+
+        if args.capture == 'scapy':
+            from . import entrance
+            entrance._import_scapy()
+            packets = [entrance.Ether(f) for f in frames]
+            feed = controller.dhcp_monitor_callback
+        else:
+            packets = [memoryview(f) for f in frames]
+
+            def feed(frame):
+                request = parse_dhcp_frame(frame)
+                if request:
+                    controller.handle_dhcp_request(request)
+
+        depths = {'resolver': [], 'songs': []}
+        feeding = [True]
+
+        def sample_depths():
+            while feeding[0]:
+                depths['resolver'].append(controller.resolvers.depth())
+                depths['songs'].append(controller.player.song_queue.qsize() + len(controller.player.pending))
+                sleep(0.01)
+
+        sampler = Thread(target=sample_depths, daemon=True)
+        sampler.start()
+
+        interval = 1.0 / args.rate if args.rate else 0
+        started = monotonic()
+        for i, packet in enumerate(packets):
+            if interval:
+                delay = started + i * interval - monotonic()
+                if delay > 0:
+                    sleep(delay)
+            t = monotonic()
+            feed(packet)
+            times.record('capture', monotonic() - t)
+        fed = monotonic() - started
+
+        controller.resolvers.queue.join()
+        resolved = monotonic() - started
+        deadline = monotonic() + args.drain_timeout
+        while monotonic() < deadline and (not controller.player.song_queue.empty() or controller.player.pending
+                                          or controller.player.current_thread):
+            sleep(0.05)
+        feeding[0] = False
+        songs_left = controller.player.song_queue.qsize() + len(controller.player.pending)
+        players_dead = [p.name for p in controller.players if not p.is_alive()]
+        controller.stop()
+
+        songs_played = len(times.samples.get('player_wait', []))
+        print('Packets:        {} in {:.2f}s ({:.0f} packets/sec fed, {:.0f} packets/sec resolved)'.format(
+            len(packets), fed, len(packets) / fed if fed else 0, len(packets) / resolved if resolved else 0))
+        print('Dropped:        {} by MAC cooldown, {} by full queue, {} by owner cooldown'.format(
+            controller.mac_cooldown.dropped, controller.resolvers.stats.dropped, controller.owner_cooldown.dropped))
+        print('Songs:          {} played, {} still queued'.format(songs_played, songs_left))
+        print('API calls:      {} total, {}'.format(stub.total_calls(), dict(stub.calls)))
+        if songs_played > 0:
+            print('API per song:   {:.1f}'.format(stub.total_calls() / float(songs_played)))
+        for name, values in depths.items():
+            if values:
+                print('Queue depth:    {:<9} max={} mean={:.1f}'.format(name, max(values), sum(values) / len(values)))
+        print('Stage latency:')
+        for line in times.summary():
+            print(line)
+
+        if songs_left:
+            print('FAILED: {} songs were never played'.format(songs_left))
+        if players_dead:
+            print('FAILED: the player stopped early ({})'.format(', '.join(players_dead)))
+        if thread_errors:
+            print('FAILED: {} threads died ({})'.format(len(thread_errors), ', '.join(thread_errors)))
+        failed = bool(songs_left or players_dead or thread_errors)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        threading.excepthook = default_excepthook
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Bulk import and export of devices and songs.
+
+Loads CSV or JSON Lines files into the database in batches, updating devices that are
+already there by MAC address, and dumps the database back out in the same formats. Also
+has a benchmark that fills a throwaway database with a lot of devices and times the import
+and device lookups at that size.
+
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import monotonic
+
+from . import data
+from .bench import synthetic_macs
+from .metrics import StageTimes
+from .models import Base
+
+DEVICE_FIELDS = ['mac_address', 'hostname', 'friendly_name', 'owner']
+SONG_FIELDS = ['owner', 'artist', 'title', 'start_minutes', 'start_seconds', 'duration']
+INT_FIELDS = {'start_minutes', 'start_seconds', 'duration'}
+FIELDS = {'devices': DEVICE_FIELDS, 'songs': SONG_FIELDS}
+
+DEFAULT_BENCH_DEVICES = 100000
+DEFAULT_BENCH_LOOKUPS = 1000
+
+
+def guess_format(path):
+    """Guesses csv or jsonl from a file name"""
+    return 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.json', '.ndjson') else 'csv'
+
+
+def _clean(row, fields):
+    """Keeps just the fields we know, with blanks as None and numbers as ints"""
+    cleaned = {}
+    for field in fields:
+        value = row.get(field)
+        if isinstance(value, str):
+            value = value.strip() or None
+        if value is not None and field in INT_FIELDS:
+            value = int(value)
+        cleaned[field] = value
+    return cleaned
+
+
+def read_rows(f, fmt, fields):
+    """Yields dicts from an open CSV (with a header row) or JSON Lines file"""
+    if fmt == 'csv':
+        rows = csv.DictReader(f)
+    else:
+        rows = (json.loads(line) for line in f if line.strip())
+    for row in rows:
+        yield _clean(row, fields)
+
+
+def write_rows(f, fmt, fields, rows):
+    """Writes dicts to an open file as CSV or JSON Lines. Returns how many were written."""
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+            count += 1
+    return count
+
+
+def _open(path, mode):
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    return open(path, mode, newline='')
+
+
+def import_file(path, kind, fmt=None, batch_size=data.BULK_BATCH_SIZE):
+    """Imports devices or songs from a file. Returns a line to print about it."""
+    fmt = fmt or guess_format(path)
+    started = monotonic()
+    f = _open(path, 'r')
+    try:
+        rows = read_rows(f, fmt, FIELDS[kind])
+        if kind == 'devices':
+            inserted, updated = data.bulk_upsert_devices((r for r in rows if r['mac_address']), batch_size)
+            summary = '{} devices added, {} updated'.format(inserted, updated)
+        else:
+            summary = '{} songs added'.format(data.bulk_replace_songs(rows, batch_size))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return '{} in {:.2f}s'.format(summary, monotonic() - started)
+
+
+def export_file(path, kind, fmt=None):
+    """Exports every device or song to a file. Returns how many rows were written."""
+    fmt = fmt or guess_format(path)
+    rows = data.iter_device_rows() if kind == 'devices' else data.iter_song_rows()
+    f = _open(path, 'w')
+    try:
+        return write_rows(f, fmt, FIELDS[kind], rows)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+def benchmark(device_count=DEFAULT_BENCH_DEVICES, lookups=DEFAULT_BENCH_LOOKUPS, batch_size=data.BULK_BATCH_SIZE):
+    """Imports device_count made up devices into a throwaway database, then times
+    get_device_by_mac_addr (exact and virtual) and the in-memory index at that size.
+
+    Returns lines to print
+    """
+    lines = []
+    workdir = tempfile.mkdtemp(prefix='entrancesong-bulk-')
+    try:
+        data.configure('sqlite:///' + os.path.join(workdir, 'bulk.db'))
+        Base.metadata.create_all(data.get_engine())
+        data.migrate()
+
+        macs = synthetic_macs(device_count)
+        path = os.path.join(workdir, 'devices.csv')
+        with open(path, 'w', newline='') as f:
+            write_rows(f, 'csv', DEVICE_FIELDS, (
+                {'mac_address': mac, 'hostname': 'host-{}'.format(i), 'friendly_name': 'device {}'.format(i),
+                 'owner': 'owner {}'.format(i // 2)} for i, mac in enumerate(macs)))
+
+        lines.append('Import:  ' + import_file(path, 'devices', batch_size=batch_size))
+        lines.append('Re-import (all updates):  ' + import_file(path, 'devices', batch_size=batch_size))
+
+        started = monotonic()
+        count = export_file(os.path.join(workdir, 'export.csv'), 'devices')
+        lines.append('Export:  {} devices in {:.2f}s'.format(count, monotonic() - started))
+
+        times = StageTimes()
+        sample = random.sample(macs, min(lookups, len(macs)))
+        # Same last three octets, different first three, so the exact match misses
+        virtual = ['0a:bb:cc' + mac[8:] for mac in sample]
+        unknown = ['0e:ff:ff:{:02x}:{:02x}:{:02x}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+                   for i in range(len(sample))]
+
+        started = monotonic()
+        data.device_index.refresh()
+        times.record('index_build', monotonic() - started)
+
+        for name, mac_list, use_virtual, lookup in (
+                ('db_exact', sample, False, data.get_device_by_mac_addr),
+                ('db_virtual', virtual, True, data.get_device_by_mac_addr),
+                ('db_miss', unknown, False, data.get_device_by_mac_addr),
+                ('index_exact', sample, False, data.lookup_device),
+                ('index_virtual', virtual, True, data.lookup_device)):
+            found = 0
+            for mac in mac_list:
+                started = monotonic()
+                found += lookup(mac, use_virtual) is not None
+                times.record(name, monotonic() - started)
+            if found != (0 if name == 'db_miss' else len(mac_list)):
+                lines.append('{} found {} of {}'.format(name, found, len(mac_list)))
+
+        lines.append('Lookups at {} devices:'.format(device_count))
+        lines.extend(times.summary())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return lines
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING, format='[%(asctime)s %(levelname)s] %(message)s',
+                        datefmt='%Y %b %d %H:%M:%S')
+
+    parser = argparse.ArgumentParser(description='Bulk loads and dumps devices and songs')
+    subparsers = parser.add_subparsers(dest='command')
+
+    import_parser = subparsers.add_parser('import', help='Add or update devices, or replace owners\' songs')
+    import_parser.add_argument('kind', choices=sorted(FIELDS))
+    import_parser.add_argument('path', help='A .csv or .jsonl file, or - for stdin')
+    import_parser.add_argument('--format', dest='fmt', choices=['csv', 'jsonl'], default=None,
+                               help='Defaults to guessing from the file name')
+    import_parser.add_argument('--batch-size', dest='batch_size', action='store', default=data.BULK_BATCH_SIZE,
+                               type=int)
+
+    export_parser = subparsers.add_parser('export', help='Write out every device or song')
+    export_parser.add_argument('kind', choices=sorted(FIELDS))
+    export_parser.add_argument('path', help='A .csv or .jsonl file, or - for stdout')
+    export_parser.add_argument('--format', dest='fmt', choices=['csv', 'jsonl'], default=None,
+                               help='Defaults to guessing from the file name')
+
+    bench_parser = subparsers.add_parser('benchmark', help='Time imports and lookups with lots of devices')
+    bench_parser.add_argument('--devices', dest='devices', action='store', default=DEFAULT_BENCH_DEVICES, type=int)
+    bench_parser.add_argument('--lookups', dest='lookups', action='store', default=DEFAULT_BENCH_LOOKUPS, type=int)
+    bench_parser.add_argument('--batch-size', dest='batch_size', action='store', default=data.BULK_BATCH_SIZE,
+                              type=int)
+    bench_parser.add_argument('--seed', dest='seed', action='store', default=1, type=int)
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        data.migrate()
+        print(import_file(args.path, args.kind, args.fmt, args.batch_size))
+    elif args.command == 'export':
+        count = export_file(args.path, args.kind, args.fmt)
+        if args.path != '-':
+            print('Wrote {} {}'.format(count, args.kind))
+    elif args.command == 'benchmark':
+        random.seed(args.seed)
+        for line in benchmark(args.devices, args.lookups, args.batch_size):
+            print(line)
+    else:
+        parser.print_help()
+        exit(1)
+
+if __name__ == '__main__':
+    main()
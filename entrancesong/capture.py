@@ -0,0 +1,181 @@
+"""Lightweight DHCP capture without scapy.
+
+Reads frames off a raw AF_PACKET socket (Linux only) and pulls out just the fields the
+controller needs, straight from the receive buffer.
+
+"""
+from collections import namedtuple
+import ctypes
+import logging
+import socket
+import struct
+from time import monotonic
+
+# DHCP message types (option 53)
+DHCP_DISCOVER = 1
+DHCP_REQUEST = 3
+
+# A parsed DHCP packet. hostname and requested_addr are None if the option wasn't sent.
+# received_at is the monotonic() time the packet was parsed, and iface the interface it
+# was sniffed on (None if we were sniffing on all of them).
+DhcpRequest = namedtuple('DhcpRequest', ['mac_addr', 'message_type', 'hostname', 'requested_addr', 'received_at',
+                                         'iface'])
+
+ETH_P_IP = 0x0800
+SO_ATTACH_FILTER = 26
+SNAPLEN = 2048
+
+ETH_HEADER_LEN = 14
+UDP_HEADER_LEN = 8
+BOOTP_OPTIONS_OFFSET = 240
+MAGIC_COOKIE = b'\x63\x82\x53\x63'
+
+OPTION_PAD = 0
+OPTION_HOSTNAME = 12
+OPTION_REQUESTED_ADDR = 50
+OPTION_MESSAGE_TYPE = 53
+OPTION_END = 255
+
+# Classic BPF for 'udp and (port 67 or 68)' on IPv4, the same filter we give scapy.
+# Each entry is (code, jt, jf, k).
+DHCP_BPF_FILTER = [
+    (0x28, 0, 0, 0x0000000c),   # ldh [12]              ethertype
+    (0x15, 0, 11, 0x00000800),  # jeq #0x800            IPv4 or drop
+    (0x30, 0, 0, 0x00000017),   # ldb [23]              IP protocol
+    (0x15, 0, 9, 0x00000011),   # jeq #17               UDP or drop
+    (0x28, 0, 0, 0x00000014),   # ldh [20]              fragment offset
+    (0x45, 7, 0, 0x00001fff),   # jset #0x1fff          drop fragments
+    (0xb1, 0, 0, 0x0000000e),   # ldxb 4*([14]&0xf)     IP header length
+    (0x48, 0, 0, 0x0000000e),   # ldh [x + 14]          source port
+    (0x15, 5, 0, 0x00000043),   # jeq #67
+    (0x15, 4, 0, 0x00000044),   # jeq #68
+    (0x48, 0, 0, 0x00000010),   # ldh [x + 16]          destination port
+    (0x15, 2, 0, 0x00000043),   # jeq #67
+    (0x15, 1, 0, 0x00000044),   # jeq #68
+    (0x06, 0, 0, 0x00000000),   # ret #0                drop
+    (0x06, 0, 0, 0x00040000),   # ret #262144           accept
+]
+
+
+def format_mac(buf):
+    """Formats 6 bytes as a lower case, colon separated MAC address"""
+    return '%02x:%02x:%02x:%02x:%02x:%02x' % tuple(buf)
+
+
+def parse_dhcp_frame(frame, iface=None):
+    """Parses an Ethernet frame holding a DHCP packet.
+
+    Args:
+        frame - A memoryview (or bytes) of the whole Ethernet frame
+        iface - The interface the frame came in on, if known
+
+    Returns a DhcpRequest, or None if this isn't a DHCP packet we can read
+    """
+    length = len(frame)
+    if length < ETH_HEADER_LEN + 20:
+        return None
+
+    ip_start = ETH_HEADER_LEN
+    ihl = (frame[ip_start] & 0x0f) * 4
+    bootp = ip_start + ihl + UDP_HEADER_LEN
+    options = bootp + BOOTP_OPTIONS_OFFSET
+    if length < options or frame[options - 4:options] != MAGIC_COOKIE:
+        return None
+
+    message_type = None
+    hostname = None
+    requested_addr = None
+
+    i = options
+    while i < length:
+        code = frame[i]
+        if code == OPTION_END:
+            break
+        if code == OPTION_PAD:
+            i += 1
+            continue
+        if i + 1 >= length:
+            break
+        size = frame[i + 1]
+        value = i + 2
+        if value + size > length:
+            break
+
+        if code == OPTION_MESSAGE_TYPE and size >= 1:
+            message_type = frame[value]
+        elif code == OPTION_HOSTNAME:
+            hostname = str(frame[value:value + size], 'utf-8', 'replace')
+        elif code == OPTION_REQUESTED_ADDR and size == 4:
+            requested_addr = '%d.%d.%d.%d' % tuple(frame[value:value + 4])
+        i = value + size
+
+    if message_type is None:
+        return None
+
+    return DhcpRequest(format_mac(frame[6:12]), message_type, hostname, requested_addr, monotonic(), iface)
+
+
+def _attach_filter(sock, program):
+    """Attaches a classic BPF program to a socket"""
+    insns = b''.join(struct.pack('HBBI', *insn) for insn in program)
+    buf = ctypes.create_string_buffer(insns)
+    fprog = struct.pack('HL', len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class RawDhcpSniffer(object):
+    """Sniffs DHCP packets on a raw AF_PACKET socket and hands DhcpRequests to a callback.
+    Give it a different parser, BPF program and protocol to sniff for other things.
+    """
+    def __init__(self, callback, iface=None, parse=parse_dhcp_frame, program=DHCP_BPF_FILTER, protocol=ETH_P_IP):
+        """Constructor
+        Args
+            callback - Called with whatever parse returns, unless it's None
+            iface - The interface to listen on, or None for all of them
+            parse - Called with a memoryview of each frame and the interface
+            program - The classic BPF program that picks which frames we get
+            protocol - The ethertype to open the socket for
+        """
+        self.callback = callback
+        self.iface = iface
+        self.parse = parse
+        self.program = program
+        self.protocol = protocol
+        self.sock = None
+        self.running = False
+
+    def open(self):
+        """Opens the socket and attaches the filter"""
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(self.protocol))
+        _attach_filter(sock, self.program)
+        if self.iface:
+            sock.bind((self.iface, 0))
+        self.sock = sock
+
+    def close(self):
+        """Stops sniffing and closes the socket"""
+        self.running = False
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def run(self):
+        """Sniffs until closed"""
+        if not self.sock:
+            self.open()
+        logging.info('Sniffing on a raw socket (%s)', self.iface or 'all interfaces')
+
+        buf = bytearray(SNAPLEN)
+        view = memoryview(buf)
+        parse = self.parse
+        self.running = True
+        while self.running:
+            try:
+                size = self.sock.recv_into(buf)
+            except OSError:
+                if not self.running:
+                    break
+                raise
+            request = parse(view[:size], self.iface)
+            if request:
+                self.callback(request)
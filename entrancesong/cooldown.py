@@ -0,0 +1,65 @@
+"""Cooldown tables for ignoring repeats.
+
+Phones send several DHCP requests every time they join, and people wander in and out.
+A cooldown table remembers when it last let each key through and drops anything that
+comes back too soon.
+
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+DEFAULT_MAX_ENTRIES = 1024
+# Ignore more DHCP packets from the same MAC address for this long, in seconds
+DEFAULT_MAC_WINDOW = 10
+# Don't play the same person's song again for this long, in seconds
+DEFAULT_OWNER_WINDOW = 30
+
+
+class CooldownTable(object):
+    """Remembers when keys were last let through, forgetting the least recently seen
+    ones once it's full.
+    """
+    def __init__(self, window, max_entries=DEFAULT_MAX_ENTRIES):
+        """Constructor
+        Args
+            window - How long to drop a key for after letting it through, in seconds
+            max_entries - How many keys to remember
+        """
+        self.window = window
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = Lock()
+        self.dropped = 0
+
+    def allow(self, key, now=None):
+        """Checks a key. Returns True and starts its cooldown if it isn't cooling down
+        already, otherwise returns False.
+        """
+        now = monotonic() if now is None else now
+        with self._lock:
+            last = self._seen.get(key)
+            if last is not None and now - last < self.window:
+                self.dropped += 1
+                return False
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return True
+
+    def remaining(self, key, now=None):
+        """Returns how many seconds are left on a key's cooldown, or 0"""
+        now = monotonic() if now is None else now
+        last = self._seen.get(key)
+        if last is None:
+            return 0
+        return max(0, self.window - (now - last))
+
+    def forget(self, key):
+        """Ends a key's cooldown early"""
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
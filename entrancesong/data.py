@@ -1,18 +1,358 @@
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Event, Lock, Thread
 import logging
+import os
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, select, text
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 
-from .models import DEFAULT_DB, Device, Owner, Song
+from .models import DEFAULT_DB, ArrivalLog, Device, Owner, Song, SearchResult
 
 # If true, dump the data as we get it
 DEBUG = False
 
-# boilerplate sqlalchemy stuff
-Session = sessionmaker()
-engine = create_engine(DEFAULT_DB)
-Session.configure(bind=engine)
+# SQLite settings for the tuned engine
+MMAP_SIZE = 64 * 1024 * 1024
+BUSY_TIMEOUT_MS = 5000
+POOL_SIZE = 5
+
+# Owner of devices nobody has claimed yet
+DEFAULT_OWNER_NAME = 'unknown owner'
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA mmap_size={}'.format(MMAP_SIZE))
+    cursor.execute('PRAGMA busy_timeout={}'.format(BUSY_TIMEOUT_MS))
+    cursor.close()
+
+
+def make_engine(db_url=DEFAULT_DB, tuned=True):
+    """Creates an engine for the database.
+
+    Args:
+        db_url - The SQLAlchemy database URL
+        tuned - If true, pools connections across threads and turns on WAL mode,
+            synchronous=NORMAL and memory mapped I/O so readers and writers don't block
+            each other
+    """
+    if not tuned or not db_url.startswith('sqlite:///'):
+        return create_engine(db_url)
+    tuned_engine = create_engine(db_url, poolclass=QueuePool, pool_size=POOL_SIZE,
+                                 connect_args={'check_same_thread': False})
+    event.listen(tuned_engine, 'connect', _set_sqlite_pragmas)
+    return tuned_engine
+
+
+# boilerplate sqlalchemy stuff. The engine isn't built until something first needs the
+# database, so importing this module stays cheap.
+_session_factory = sessionmaker()
+_engine_lock = Lock()
+_db_url = DEFAULT_DB
+_tuned = True
+engine = None
+
+
+def get_engine():
+    """Gets the engine, building it the first time"""
+    global engine
+    if engine is None:
+        with _engine_lock:
+            if engine is None:
+                new_engine = make_engine(_db_url, _tuned)
+                _session_factory.configure(bind=new_engine)
+                engine = new_engine
+    return engine
+
+
+def Session():
+    """Makes a new session"""
+    if engine is None:
+        get_engine()
+    return _session_factory()
+
+
+# One long-lived session per thread, for the hot path
+ScopedSession = scoped_session(Session)
+
+
+def configure(db_url=DEFAULT_DB, tuned=True):
+    """Points this module at a different database, or switches tuning on or off"""
+    global engine, _db_url, _tuned, _default_owner_id
+    ScopedSession.remove()
+    with _engine_lock:
+        _db_url = db_url
+        _tuned = tuned
+        engine = None
+    _default_owner_id = None
+    device_index.db_path = _sqlite_path(db_url)
+    device_index.invalidate()
+
+
+def _sqlite_path(db_url):
+    """Gets the file path from a SQLite URL, or None for anything else"""
+    if db_url.startswith('sqlite:///'):
+        return db_url[len('sqlite:///'):] or None
+    return None
+
+
+@contextmanager
+def session_scope():
+    """Provides this thread's long-lived session, committing (or rolling back) when done.
+    Committing also expires everything loaded, so the next scope sees fresh rows.
+    """
+    session = ScopedSession()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+# Compact, read-only copies of the rows the DHCP callback needs. These mirror the
+# attribute names on the models so callers can use either one.
+SongRecord = namedtuple('SongRecord', ['artist', 'title', 'start_minutes', 'start_seconds', 'duration'])
+OwnerRecord = namedtuple('OwnerRecord', ['name', 'song'])
+DeviceRecord = namedtuple('DeviceRecord', ['mac_address', 'hostname', 'friendly_name', 'owner'])
+CachedSearch = namedtuple('CachedSearch', ['uri', 'name', 'resolved_at', 'duration_ms'])
+
+
+def normalize_mac(mac_addr):
+    """Normalizes a MAC address to lower case, colon separated"""
+    return mac_addr.strip().lower().replace('-', ':')
+
+
+def mac_suffix(mac_addr):
+    """Gets the last three octets of a MAC address (e.g. '07:6b:d1')"""
+    return normalize_mac(mac_addr)[-8:]
+
+
+# Just the columns a DeviceRecord needs, one row per device and song
+_DEVICE_RECORD_COLUMNS = (Device.mac_address, Device.hostname, Device.friendly_name, Owner.name,
+                          Song.artist, Song.title, Song.start_minutes, Song.start_seconds, Song.duration)
+
+
+def _query_device_records(session, mac_addr=None):
+    """Loads DeviceRecords without going through the ORM relationships, which would also
+    load every other device the owner has.
+
+    Returns a dict of MAC address -> DeviceRecord
+    """
+    query = session.query(*_DEVICE_RECORD_COLUMNS) \
+        .outerjoin(Owner, Device.owner_id == Owner.id) \
+        .outerjoin(Song, Song.owner_id == Owner.id)
+    if mac_addr is not None:
+        query = query.filter(Device.mac_address == mac_addr)
+
+    devices = OrderedDict()
+    for mac, hostname, friendly_name, owner_name, *song in query.order_by(Device.mac_address, Song.id):
+        mac = normalize_mac(mac)
+        if mac not in devices:
+            devices[mac] = (hostname, friendly_name, owner_name, [])
+        if song[0] is not None or song[1] is not None:
+            devices[mac][3].append(SongRecord(*song))
+
+    return {mac: DeviceRecord(mac, hostname, friendly_name,
+                              OwnerRecord(owner_name, tuple(songs)) if owner_name is not None else None)
+            for mac, (hostname, friendly_name, owner_name, songs) in devices.items()}
+
+
+def get_device_record(mac_addr):
+    """Gets a DeviceRecord straight from the database, or None if it isn't there"""
+    with session_scope() as session:
+        return _query_device_records(session, mac_addr).get(normalize_mac(mac_addr))
+
+
+def migrate():
+    """Brings an existing database up to date: adds any new tables and columns, and the
+    indexes used by the device lookups.
+    """
+    create_search_result_table()
+    engine = get_engine()
+    ArrivalLog.__table__.create(engine, checkfirst=True)
+    indexes = {}
+    for table in ('device', 'song'):
+        for row in engine.execute('PRAGMA index_list({})'.format(table)):
+            columns = [info[2] for info in engine.execute('PRAGMA index_info("{}")'.format(row[1]))]
+            indexes.setdefault(table, []).append(columns)
+
+    if ['mac_address'] not in indexes.get('device', []):
+        logging.info('Adding an index on device.mac_address')
+        engine.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_device_mac_address ON device (mac_address)')
+    if ['owner_id'] not in indexes.get('device', []):
+        logging.info('Adding an index on device.owner_id')
+        engine.execute('CREATE INDEX IF NOT EXISTS ix_device_owner_id ON device (owner_id)')
+    if ['owner_id'] not in indexes.get('song', []):
+        logging.info('Adding an index on song.owner_id')
+        engine.execute('CREATE INDEX IF NOT EXISTS ix_song_owner_id ON song (owner_id)')
+
+
+class DeviceIndex(object):
+    """In-memory index of MAC address -> DeviceRecord.
+
+    Built from the database once and rebuilt in the background whenever the database file
+    changes on disk, so known devices are resolved without touching the database. Devices
+    this process inserts are added in place. Also keeps a map of the last three octets of
+    each MAC address for virtual MAC lookups.
+    """
+    def __init__(self, db_path):
+        """Constructor
+        Args
+            db_path - Path to the SQLite file, used to notice changes made by other processes
+        """
+        self.db_path = db_path
+        self._lock = Lock()
+        # Held for a whole rebuild, so only one runs at a time
+        self._refresh_lock = Lock()
+        self._refreshing = False
+        # (by_mac, by_suffix), swapped as a single reference so readers don't need the lock
+        self._maps = None
+        self._mtime = None
+
+    def _db_mtime(self):
+        """Gets the modification times of the database and its write-ahead log. In WAL
+        mode, commits only touch the log until it's checkpointed.
+        """
+        mtimes = []
+        for path in (self.db_path, '{}-wal'.format(self.db_path)):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except (OSError, TypeError):
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def refresh(self):
+        """Rebuilds the index from the database"""
+        with self._refresh_lock:
+            return self._rebuild()
+
+    def _rebuild(self):
+        mtime = self._db_mtime()
+        with session_scope() as session:
+            by_mac = _query_device_records(session)
+
+        by_suffix = {}
+        for mac in sorted(by_mac):
+            by_suffix.setdefault(mac_suffix(mac), []).append(by_mac[mac])
+        by_suffix = {suffix: tuple(records) for suffix, records in by_suffix.items()}
+
+        maps = (by_mac, by_suffix)
+        with self._lock:
+            self._maps = maps
+            self._mtime = mtime
+        logging.info('Loaded %d devices into the MAC index', len(by_mac))
+        return maps
+
+    def _refresh_in_background(self):
+        """Starts a rebuild on its own thread unless one is already running"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error('Could not rebuild the MAC index: %s', e)
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        Thread(target=run, name='device-index-refresh', daemon=True).start()
+
+    @contextmanager
+    def unrelated_write(self):
+        """Wraps a write to a table the index doesn't use, so the database changing on disk
+        doesn't make the index look stale
+        """
+        current = self._maps is not None and self._db_mtime() == self._mtime
+        yield
+        if current:
+            with self._lock:
+                if self._maps is not None:
+                    self._mtime = self._db_mtime()
+
+    @contextmanager
+    def adding(self):
+        """Wraps an insert of devices this process makes. Yields a list to put the new
+        DeviceRecords in once they're committed, and adds them to copies of the maps
+        instead of rebuilding. If the index was already stale it's left stale, so the
+        other changes still get picked up.
+        """
+        current = self._maps is not None and self._db_mtime() == self._mtime
+        records = []
+        yield records
+        if not records:
+            return
+        with self._lock:
+            if self._maps is None:
+                return
+            by_mac, by_suffix = dict(self._maps[0]), dict(self._maps[1])
+            for record in records:
+                by_mac[record.mac_address] = record
+                suffix = mac_suffix(record.mac_address)
+                others = [r for r in by_suffix.get(suffix, ()) if r.mac_address != record.mac_address]
+                by_suffix[suffix] = tuple(sorted(others + [record], key=lambda r: r.mac_address))
+            self._maps = (by_mac, by_suffix)
+            if current:
+                self._mtime = self._db_mtime()
+
+    def is_stale(self):
+        """Whether the database has changed since the maps were built"""
+        return self._maps is None or self._db_mtime() != self._mtime
+
+    def records(self):
+        """Gets every DeviceRecord"""
+        return list(self._current()[0].values())
+
+    def invalidate(self):
+        """Forces a rebuild on the next lookup"""
+        with self._lock:
+            self._maps = None
+
+    def _current(self):
+        """Returns the current (by_mac, by_suffix) maps. The first lookup waits for them to
+        load; after that, stale maps keep being served while a rebuild runs in the background.
+        """
+        maps = self._maps
+        if maps is None:
+            with self._refresh_lock:
+                maps = self._maps
+                if maps is None:
+                    maps = self._rebuild()
+        elif self._db_mtime() != self._mtime:
+            self._refresh_in_background()
+        return maps
+
+    def get(self, mac_addr):
+        """Gets the DeviceRecord for a MAC address, or None if it isn't known"""
+        return self._current()[0].get(normalize_mac(mac_addr))
+
+    def get_by_suffix(self, mac_addr):
+        """Gets every DeviceRecord whose MAC address ends with the same last three octets
+        as mac_addr, sorted by MAC address. Returns an empty tuple if there are none.
+        """
+        return self._current()[1].get(mac_suffix(mac_addr), ())
+
+    def __len__(self):
+        maps = self._maps
+        return len(maps[0]) if maps else 0
+
+
+device_index = DeviceIndex(_sqlite_path(DEFAULT_DB))
+
+def db_mtime():
+    """Gets the database's modification times the same way the device index does, for other
+    in-memory copies of tables that need to notice changes made by other processes
+    """
+    return device_index._db_mtime()
 
 def get_all_devices():
     """Gets all the devices in the database"""
@@ -37,9 +377,10 @@ def get_device_by_mac_addr(mac_addr, use_virtual=False):
     session = Session()
     device = session.query(Device).filter(Device.mac_address==mac_addr).first()
     if not device and use_virtual:
-        last_three_bytes = mac_addr[9:]
+        last_three_bytes = mac_suffix(mac_addr)
         logging.info('No device found. Looking for a match for *:*:*:%s', last_three_bytes)
-        device = session.query(Device).filter(Device.mac_address.contains(last_three_bytes)).first()
+        device = session.query(Device).filter(Device.mac_address.endswith(last_three_bytes)) \
+            .order_by(Device.mac_address).first()
         if device:
             logging.info('Found one at %s', device.mac_address)
 
@@ -47,6 +388,29 @@ def get_device_by_mac_addr(mac_addr, use_virtual=False):
 
     return device
 
+def lookup_device(mac_addr, use_virtual=False):
+    """Gets a DeviceRecord by MAC address from the in-memory index, or None if it's not known.
+    Arguments:
+        mac_addr - The MAC address to search on
+        use_virtual - If true, falls back to matching the last 3 bytes of the MAC address
+    """
+    record = device_index.get(mac_addr)
+    if record is None and device_index.is_stale():
+        # The index is being rebuilt in the background, and the device may have just been added
+        record = get_device_record(mac_addr)
+    if record or not use_virtual:
+        return record
+
+    matches = device_index.get_by_suffix(mac_addr)
+    if not matches:
+        return None
+    if len(matches) > 1:
+        logging.warning('%s matches %d devices: %s. Using %s', mac_suffix(mac_addr), len(matches),
+                        ', '.join(m.mac_address for m in matches), matches[0].mac_address)
+    else:
+        logging.info('Found one at %s', matches[0].mac_address)
+    return matches[0]
+
 def insert_device(mac_addr, hostname=None, friendly_name='unknown device', owner=None):
     """Inserts a device into the database."""
     if not owner:
@@ -62,20 +426,394 @@ def insert_device(mac_addr, hostname=None, friendly_name='unknown device', owner
         print(e)
 
     session.close()
+    device_index.invalidate()
     return device
 
 def _get_default_owner():
     session = Session()
-    default_owner = session.query(Owner).filter(Owner.name=='unknown owner').first()
+    default_owner = session.query(Owner).filter(Owner.name==DEFAULT_OWNER_NAME).first()
     if not default_owner:
         # Create a new default owner
-        default_owner = Owner(name='unknown owner')
+        default_owner = Owner(name=DEFAULT_OWNER_NAME)
         session.add(default_owner)
         session.commit()
+        # The commit expired it, so load the ID while there's still a session to load it from
+        default_owner.id
 
     session.close()
     return default_owner
 
+_default_owner_id = None
+_default_owner_lock = Lock()
+
+def _get_default_owner_id():
+    """Gets the ID of the default owner, only going to the database the first time"""
+    global _default_owner_id
+    with _default_owner_lock:
+        if _default_owner_id is None:
+            _default_owner_id = _get_default_owner().id
+        return _default_owner_id
+
+
+class BatchWriter(object):
+    """Base for write-behind buffers. Subclasses hold rows in _pending and write them all in
+    flush(), which runs once enough of them pile up or enough time passes.
+    """
+    name = 'batch-writer'
+
+    def __init__(self, max_pending=50, flush_interval=5.0):
+        """Constructor
+        Args
+            max_pending - Flush as soon as this many rows are waiting
+            flush_interval - Flush at least this often, in seconds
+        """
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._pending = OrderedDict()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the background thread that flushes on the interval"""
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and flushes whatever is left"""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def pending(self):
+        """Returns how many rows are waiting to be written"""
+        return len(self._pending)
+
+    def flush(self):
+        """Writes everything that's waiting. Returns how many rows were written."""
+        raise NotImplementedError
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.exception('Error flushing %s: %s', self.name, e)
+
+
+class DeviceWriter(BatchWriter):
+    """Write-behind buffer for inserting unknown devices.
+
+    Devices are held in memory and inserted together in one transaction once enough of
+    them pile up or enough time passes. A MAC address that's already waiting is ignored.
+    """
+    name = 'device-writer'
+
+    def add(self, mac_addr, hostname=None, friendly_name='unknown device'):
+        """Queues a device to be inserted. Returns False if it was already waiting."""
+        mac_addr = normalize_mac(mac_addr)
+        with self._lock:
+            if mac_addr in self._pending:
+                return False
+            self._pending[mac_addr] = (hostname, friendly_name)
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Inserts everything that's waiting in a single transaction"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch = self._pending
+                self._pending = OrderedDict()
+
+            try:
+                owner_id = _get_default_owner_id()
+                with device_index.adding() as added:
+                    with session_scope() as session:
+                        existing = {mac for (mac,) in session.query(Device.mac_address)
+                                    .filter(Device.mac_address.in_(list(batch)))}
+                        new_devices = [Device(mac_address=mac, hostname=hostname, friendly_name=friendly_name,
+                                              owner_id=owner_id)
+                                       for mac, (hostname, friendly_name) in batch.items() if mac not in existing]
+                        session.add_all(new_devices)
+                    # New devices go to the default owner, who has no songs
+                    owner = OwnerRecord(DEFAULT_OWNER_NAME, ())
+                    added.extend(DeviceRecord(mac, hostname, friendly_name, owner)
+                                 for mac, (hostname, friendly_name) in batch.items() if mac not in existing)
+            except Exception as e:
+                # Put them back to try again on the next flush
+                logging.error('Could not add %d devices: %s', len(batch), e)
+                with self._lock:
+                    for mac, device in self._pending.items():
+                        batch.setdefault(mac, device)
+                    self._pending = batch
+                return 0
+
+        logging.info('Added %d new devices to the database', len(new_devices))
+        return len(new_devices)
+
+
+device_writer = DeviceWriter()
+
+
+class ArrivalWriter(BatchWriter):
+    """Write-behind buffer for the arrival log. Rows are appended in one executemany per
+    flush, off the arrival path.
+    """
+    name = 'arrival-writer'
+
+    def __init__(self, max_pending=50, flush_interval=30.0):
+        super().__init__(max_pending, flush_interval)
+        self._pending = []
+
+    def add(self, owner_name, mac_addr, outcome, signal=None, iface=None, arrived_at=None, latency=None):
+        """Queues an arrival to be logged
+
+        Args:
+            owner_name - Who arrived
+            mac_addr - The device they were seen with
+            outcome - What happened: played, cooldown or no_song
+            signal - What gave them away, e.g. dhcp-request
+            iface - The interface they were seen on
+            arrived_at - When, as a datetime. Defaults to now.
+            latency - Seconds from the packet to the music starting, if it played
+        """
+        row = {'owner_name': owner_name, 'mac_address': normalize_mac(mac_addr), 'outcome': outcome,
+               'signal': signal, 'iface': iface, 'arrived_at': arrived_at or datetime.now(),
+               'latency_ms': int(latency * 1000) if latency is not None else None}
+        with self._lock:
+            self._pending.append(row)
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Appends everything that's waiting to the arrival table"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch = self._pending
+                self._pending = []
+            try:
+                with device_index.unrelated_write():
+                    with get_engine().begin() as conn:
+                        conn.execute(ArrivalLog.__table__.insert(), batch)
+            except Exception as e:
+                logging.error('Could not log %d arrivals: %s', len(batch), e)
+                return 0
+        logging.debug('Logged %d arrivals', len(batch))
+        return len(batch)
+
+
+arrival_writer = ArrivalWriter()
+
+
+def get_arrivals(since=None):
+    """Gets logged arrivals, oldest first, as ArrivalLog rows
+
+    Args:
+        since - Only get arrivals after this datetime
+    """
+    session = Session()
+    query = session.query(ArrivalLog)
+    if since is not None:
+        query = query.filter(ArrivalLog.arrived_at >= since)
+    arrivals = query.order_by(ArrivalLog.arrived_at).all()
+    session.close()
+    return arrivals
+
+# Rows per executemany (and per transaction) in the bulk helpers
+BULK_BATCH_SIZE = 5000
+# Values per IN (...) lookup in the bulk helpers
+MAX_SQL_PARAMS = 900
+
+_UPDATE_DEVICE = text('UPDATE device SET hostname = COALESCE(:hostname, hostname), '
+                      'friendly_name = COALESCE(:friendly_name, friendly_name), '
+                      'owner_id = COALESCE(:owner_id, owner_id) WHERE mac_address = :mac_address')
+_INSERT_DEVICE = text('INSERT OR IGNORE INTO device (mac_address, hostname, friendly_name, owner_id) '
+                      'VALUES (:mac_address, :hostname, :friendly_name, :owner_id)')
+_INSERT_SONG = text('INSERT INTO song (owner_id, artist, title, start_minutes, start_seconds, duration) '
+                    'VALUES (:owner_id, :artist, :title, :start_minutes, :start_seconds, :duration)')
+
+
+def _batches(rows, size):
+    """Splits an iterable into lists of up to size items"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _owner_ids(conn, names):
+    """Adds any owners that don't exist yet. Returns a dict of name -> ID for the names."""
+    names = {name for name in names if name}
+    if not names:
+        return {}
+    conn.execute(text('INSERT OR IGNORE INTO owner (name) VALUES (:name)'), [{'name': n} for n in names])
+    owners = Owner.__table__
+    ids = {}
+    # Older SQLite only takes 999 parameters per statement
+    for chunk in _batches(sorted(names), MAX_SQL_PARAMS):
+        ids.update((name, owner_id) for owner_id, name in
+                   conn.execute(select([owners.c.id, owners.c.name]).where(owners.c.name.in_(chunk))))
+    return ids
+
+
+def bulk_upsert_devices(devices, batch_size=BULK_BATCH_SIZE):
+    """Inserts or updates devices by MAC address, one transaction per batch. This is an
+    UPDATE and then an INSERT OR IGNORE per batch, so it works on SQLite versions without
+    ON CONFLICT.
+
+    Args:
+        devices - Dicts with a mac_address, and optionally hostname, friendly_name and owner
+            (the owner's name, which is added if it doesn't exist). Missing or None fields
+            leave an existing device's value alone. New devices without an owner go to the
+            default owner.
+        batch_size - How many rows go in each executemany
+
+    Returns a tuple of (inserted, updated)
+    """
+    default_owner_id = _get_default_owner_id()
+    inserted = updated = 0
+    for batch in _batches(devices, batch_size):
+        with get_engine().begin() as conn:
+            owners = _owner_ids(conn, (d.get('owner') for d in batch))
+            rows = OrderedDict()
+            for device in batch:
+                mac = normalize_mac(device['mac_address'])
+                # The last row for a MAC address wins, like it would row by row
+                rows[mac] = {'mac_address': mac, 'hostname': device.get('hostname'),
+                             'friendly_name': device.get('friendly_name'),
+                             'owner_id': owners.get(device.get('owner'))}
+            rows = list(rows.values())
+            updated += conn.execute(_UPDATE_DEVICE, rows).rowcount
+            inserted += conn.execute(_INSERT_DEVICE, [
+                dict(row, friendly_name=row['friendly_name'] or 'unknown device',
+                     owner_id=row['owner_id'] or default_owner_id) for row in rows]).rowcount
+    device_index.invalidate()
+    return inserted, updated
+
+
+def bulk_replace_songs(songs, batch_size=BULK_BATCH_SIZE):
+    """Replaces the songs of every owner named in songs with the ones given, in one
+    transaction. Owners that aren't mentioned keep theirs.
+
+    Args:
+        songs - Dicts with an owner (name), artist, title, and optionally start_minutes,
+            start_seconds and duration
+        batch_size - How many rows go in each executemany
+
+    Returns how many songs were added
+    """
+    songs = list(songs)
+    added = 0
+    with get_engine().begin() as conn:
+        owners = _owner_ids(conn, (s.get('owner') for s in songs))
+        conn.execute(text('DELETE FROM song WHERE owner_id = :owner_id'),
+                     [{'owner_id': owner_id} for owner_id in owners.values()])
+        for batch in _batches(songs, batch_size):
+            rows = [{'owner_id': owners[s['owner']], 'artist': s.get('artist'), 'title': s.get('title'),
+                     'start_minutes': s.get('start_minutes') or 0, 'start_seconds': s.get('start_seconds') or 0,
+                     'duration': s.get('duration')} for s in batch if s.get('owner')]
+            if rows:
+                added += conn.execute(_INSERT_SONG, rows).rowcount
+    device_index.invalidate()
+    return added
+
+
+def iter_device_rows():
+    """Yields every device as a dict of mac_address, hostname, friendly_name and owner"""
+    result = get_engine().execute(text(
+        'SELECT device.mac_address, device.hostname, device.friendly_name, owner.name FROM device '
+        'LEFT OUTER JOIN owner ON device.owner_id = owner.id ORDER BY device.mac_address'))
+    for mac, hostname, friendly_name, owner in result:
+        yield {'mac_address': mac, 'hostname': hostname, 'friendly_name': friendly_name, 'owner': owner}
+
+
+def iter_song_rows():
+    """Yields every song as a dict of owner, artist, title, start_minutes, start_seconds and duration"""
+    result = get_engine().execute(text(
+        'SELECT owner.name, song.artist, song.title, song.start_minutes, song.start_seconds, song.duration '
+        'FROM song JOIN owner ON song.owner_id = owner.id ORDER BY owner.name, song.id'))
+    for owner, artist, title, start_minutes, start_seconds, duration in result:
+        yield {'owner': owner, 'artist': artist, 'title': title, 'start_minutes': start_minutes,
+               'start_seconds': start_seconds, 'duration': duration}
+
+def get_all_songs():
+    """Gets a SongRecord for every song in the database"""
+    session = Session()
+    songs = [SongRecord(s.artist, s.title, s.start_minutes, s.start_seconds, s.duration)
+             for s in session.query(Song).all()]
+    session.close()
+    return songs
+
+def create_search_result_table():
+    """Creates the search_result table, or adds any columns missing from an older one"""
+    engine = get_engine()
+    SearchResult.__table__.create(engine, checkfirst=True)
+    existing = {row[1] for row in engine.execute('PRAGMA table_info(search_result)')}
+    if 'duration_ms' not in existing:
+        logging.info('Adding duration_ms to the search_result table')
+        engine.execute('ALTER TABLE search_result ADD COLUMN duration_ms INTEGER')
+
+def get_search_results():
+    """Gets all cached search results as a dict of (artist, title) -> CachedSearch"""
+    session = Session()
+    results = {(r.artist, r.title): CachedSearch(r.uri, r.name, r.resolved_at, r.duration_ms)
+               for r in session.query(SearchResult).all()}
+    session.close()
+    return results
+
+def save_search_result(artist, title, uri, name, resolved_at, duration_ms=None):
+    """Inserts or updates the cached search result for an artist and title.
+    An existing duration_ms is kept if duration_ms is None.
+    """
+    session = Session()
+    result = session.query(SearchResult).filter(SearchResult.artist==artist, SearchResult.title==title).first()
+    if not result:
+        result = SearchResult(artist=artist, title=title)
+        session.add(result)
+    result.uri = uri
+    result.name = name
+    result.resolved_at = resolved_at
+    if duration_ms is not None:
+        result.duration_ms = duration_ms
+    try:
+        with device_index.unrelated_write():
+            session.commit()
+    except IntegrityError as e:
+        # Another thread cached it first
+        session.rollback()
+        logging.debug('Search result for %s - %s already saved: %s', artist, title, e)
+    session.close()
+
+def delete_search_results(artist=None, title=None):
+    """Deletes cached search results. With no arguments, deletes all of them."""
+    session = Session()
+    query = session.query(SearchResult)
+    if artist is not None:
+        query = query.filter(SearchResult.artist==artist)
+    if title is not None:
+        query = query.filter(SearchResult.title==title)
+    count = query.delete(synchronize_session=False)
+    with device_index.unrelated_write():
+        session.commit()
+    session.close()
+    return count
+
 def _insert_dummy_devices():
     """Inserts dummy data into the database"""
     session = Session()
@@ -4,29 +4,186 @@ Sniffs for DHCP requests and queues up the music.
 
 """
 import argparse
-from datetime import datetime
 import logging
 import random
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from threading import Lock, Thread
+from time import monotonic
 
-from scapy.all import Ether, DHCP, sniff
-
-from .music_player import MusicPlayer, MusicPlayerException
+from .cooldown import CooldownTable, DEFAULT_MAC_WINDOW, DEFAULT_OWNER_WINDOW, DEFAULT_MAX_ENTRIES
+from .capture import DhcpRequest, RawDhcpSniffer
+from .fade import CURVES, DEFAULT_FADE_DURATION, DEFAULT_CURVE
+from .music_player import MusicPlayer, MusicPlayerException, SPOTIPY_USER_NAME
+from .predict import ArrivalPredictor, DEFAULT_LEAD_MINUTES
+from .resolver import ResolverPool, DEFAULT_WORKERS, DEFAULT_MAX_QUEUED
+from .search_cache import SearchCache, DEFAULT_TTL_HOURS
+from .signals import SignalDetector, SIGNAL_ARP, SIGNAL_DHCP_DISCOVER, SIGNAL_DHCP_REQUEST, SIGNAL_NDP
+from .zones import ZoneMap, ZoneTarget, parse_zone
 from spotipy import SpotifyException
 from . import data
+from . import metrics as metrics_module
+from .metrics import Arrival, metrics
+
+# Filled in by _import_scapy()
+Ether = DHCP = sniff = None
+
+
+def _import_scapy():
+    """Imports just the parts of scapy we use. scapy.all loads every layer it has, which
+    takes seconds on a Raspberry Pi.
+    """
+    global Ether, DHCP, sniff
+    if sniff is None:
+        from scapy.layers.l2 import Ether
+        from scapy.layers.dhcp import DHCP
+        from scapy.sendrecv import sniff
 
 
 class EntranceController(object):
     """Class that starts listening for DHCP connections and playing music"""
-    def __init__(self, default_volume=70, device_id=None, virtual_mac=False):
+    def __init__(self, default_volume=70, device_id=None, virtual_mac=False, capture='scapy', ifaces=None,
+                 workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED, search_ttl=DEFAULT_TTL_HOURS,
+                 prewarm=True, fade_duration=DEFAULT_FADE_DURATION, fade_curve=DEFAULT_CURVE,
+                 busy_clip_limit=None, coalesce_window=None, mac_cooldown=DEFAULT_MAC_WINDOW,
+                 owner_cooldown=DEFAULT_OWNER_WINDOW, cooldown_size=DEFAULT_MAX_ENTRIES, spotify_client=None,
+                 api_base=None, fast_start=False, signals=(SIGNAL_DHCP_REQUEST,), zones=None, predict=False,
+                 predict_lead=DEFAULT_LEAD_MINUTES):
         self.virtual_mac = virtual_mac
-        self.player = MusicPlayer(default_volume=default_volume, device_id=device_id)
-        self.last_entrance = (None, None)
+        self.capture = capture
+        # One sniffer per interface. None sniffs on all of them.
+        self.ifaces = ifaces or [None]
+        self.sniffers = []
+        self.capturing = False
+        self.detector = SignalDetector(signals)
+        player_options = dict(default_volume=default_volume, fade_duration=fade_duration, fade_curve=fade_curve,
+                              busy_clip_limit=busy_clip_limit, coalesce_window=coalesce_window,
+                              spotify_client=spotify_client, api_base=api_base, connect=not fast_start)
+        # Players on the same account share a lock so they take turns
+        account_locks = defaultdict(Lock)
+        self.player = MusicPlayer(device_id=device_id, account_lock=account_locks[SPOTIPY_USER_NAME],
+                                  **player_options)
+        # A player per zone device, each with its own thread and saved playback
+        self.zones = zones or ZoneMap()
+        self.zone_players = {ZoneTarget(device_id, None): self.player}
+        for target in self.zones.all_targets():
+            if target not in self.zone_players:
+                logging.info('Adding a player for device %s%s', target.device_id,
+                             ' on account ' + target.account if target.account else '')
+                options = dict(player_options, username=target.account) if target.account else player_options
+                account_lock = account_locks[target.account or SPOTIPY_USER_NAME]
+                self.zone_players[target] = MusicPlayer(device_id=target.device_id, device_only=True,
+                                                        account_lock=account_lock, **options)
+        self._warn_shared_accounts()
+        self.search_cache = SearchCache(self.player, ttl_hours=search_ttl)
+        self.prewarm = prewarm
+        self.resolvers = ResolverPool(self.process_request, workers=workers, max_queued=max_queued)
+        # Drops DHCP retries before they reach the queue, and people who were just here
+        self.mac_cooldown = CooldownTable(mac_cooldown, cooldown_size)
+        self.owner_cooldown = CooldownTable(owner_cooldown, cooldown_size)
+        # Warms up regulars' songs and devices a little before they usually get here
+        self.predictor = ArrivalPredictor(self, lead_minutes=predict_lead) if predict else None
+        data.migrate()
+        # In fast start mode the first lookup builds the index instead
+        if not fast_start:
+            data.device_index.refresh()
+        self._register_gauges()
+
+    def _warn_shared_accounts(self):
+        """Warns about devices, the default one included, that can't play at the same time"""
+        accounts = {}
+        for target in self.zone_players:
+            accounts.setdefault(target.account, []).append(target.device_id or 'the active device')
+        for account, devices in accounts.items():
+            if len(devices) > 1:
+                logging.warning('%s are all on the %s account, which can only play on one of them at a time, '
+                                'so their songs will take turns', ', '.join(devices), account or 'default')
+
+    @property
+    def players(self):
+        """Every player, default first"""
+        return list(self.zone_players.values())
+
+    def players_for(self, iface, owner_name):
+        """Gets the players an arrival should play on: its zones', or the default player"""
+        targets = self.zones.targets(iface, owner_name)
+        return [self.zone_players[target] for target in targets] or [self.player]
+
+    def _register_gauges(self):
+        """Exposes the counters other parts already keep, so the hot path doesn't pay twice"""
+        metrics.gauge('resolver_queue_depth', self.resolvers.depth)
+        metrics.gauge('resolver_dropped', lambda: self.resolvers.stats.dropped)
+        metrics.gauge('mac_cooldown_dropped', lambda: self.mac_cooldown.dropped)
+        metrics.gauge('owner_cooldown_dropped', lambda: self.owner_cooldown.dropped)
+        metrics.gauge('search_cache_hits', lambda: self.search_cache.hits)
+        metrics.gauge('search_cache_misses', lambda: self.search_cache.misses)
+        metrics.gauge('song_queue_depth', lambda: sum(p.song_queue.qsize() + len(p.pending) for p in self.players))
+        metrics.gauge('known_devices', lambda: len(data.device_index))
+        metrics.gauge('arrival_log_pending', data.arrival_writer.pending)
 
     def start(self):
-        """Starts sniffing"""
-        logging.info('Starting sniffing for DHCP traffic')
-        self.player.start()
-        sniff(prn=self.dhcp_monitor_callback, filter='udp and (port 67 or 68)', store=0)
+        """Starts sniffing on every interface, and blocks until all of them stop"""
+        self.start_processing()
+        logging.info('Starting sniffing for %s on %s', ', '.join(sorted(self.detector.signals)),
+                     ', '.join(iface or 'all interfaces' for iface in self.ifaces))
+        if None in self.ifaces and len(self.ifaces) > 1:
+            logging.warning('Sniffing on all interfaces and on specific ones, so every packet will be seen twice')
+
+        if self.capture != 'raw':
+            _import_scapy()
+        self.capturing = True
+        threads = []
+        for iface in self.ifaces:
+            t = Thread(target=self._capture, args=(iface,), name='capture-%s' % (iface or 'all'), daemon=True)
+            t.start()
+            threads.append(t)
+        # Join with a timeout so Ctrl-C still gets through to this thread
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(1)
+
+    def _capture(self, iface):
+        """Sniffs on one interface until stopped. Runs on its own thread."""
+        try:
+            if self.capture == 'raw':
+                sniffer = RawDhcpSniffer(self.handle_detection, iface=iface, parse=self.detector.detect,
+                                         program=self.detector.bpf_program, protocol=self.detector.protocol)
+                self.sniffers.append(sniffer)
+                sniffer.run()
+            else:
+                sniff(prn=lambda pkt: self.scapy_callback(pkt, iface), filter=self.detector.capture_filter,
+                      store=0, iface=iface, stop_filter=lambda pkt: not self.capturing)
+        except Exception as e:
+            logging.error('Capture on %s stopped: %s', iface or 'all interfaces', e)
+
+    def start_processing(self):
+        """Starts everything behind the capture: the players, resolver workers, writers and predictor"""
+        for player in self.players:
+            player.start()
+        self.resolvers.start()
+        data.device_writer.start()
+        data.arrival_writer.start()
+        if self.prewarm:
+            Thread(target=self.search_cache.prewarm, name='prewarm', daemon=True).start()
+        if self.predictor:
+            self.predictor.start()
+
+    def stop(self):
+        """Stops capturing, the resolver workers and the players, and writes out anything that's still buffered"""
+        self.capturing = False
+        for sniffer in self.sniffers:
+            sniffer.close()
+        if self.predictor:
+            self.predictor.stop()
+        self.resolvers.stop()
+        # Each player puts its own music back, so do them all at once
+        players = self.players
+        with ThreadPoolExecutor(max_workers=len(players)) as pool:
+            list(pool.map(lambda player: player.stop(timeout=30), players))
+        data.device_writer.stop()
+        data.arrival_writer.stop()
 
     def get_dhcp_option_value(self, options, key):
         for option in options:
@@ -34,38 +191,83 @@ class EntranceController(object):
                 return option[1]
         return None
 
-    def dhcp_monitor_callback(self, pkt):
-        """Callback for DHCP requests"""
-        if not pkt.haslayer(DHCP):
-            return
-        if pkt[DHCP].options[0][1] != 3:
+    def scapy_callback(self, pkt, iface=None):
+        """Callback for every packet from scapy. ARP and NDP are parsed from the raw bytes,
+        the same way the raw backend does it.
+        """
+        if pkt.haslayer(DHCP):
+            self.dhcp_monitor_callback(pkt, iface)
             return
+        detection = self.detector.detect(bytes(pkt), iface)
+        if detection:
+            self.handle_detection(detection)
 
-        mac_addr = pkt[Ether].src
-        hostname = self.get_dhcp_option_value(pkt[DHCP].options, 'hostname')
+    def dhcp_monitor_callback(self, pkt, iface=None):
+        """Callback for DHCP packets from scapy"""
+        if not pkt.haslayer(DHCP):
+            return
+        options = pkt[DHCP].options
+        hostname = self.get_dhcp_option_value(options, 'hostname')
         if hostname:
             hostname = hostname.decode('utf-8')
-        ip = self.get_dhcp_option_value(pkt[DHCP].options, 'requested_addr')
+        request = DhcpRequest(pkt[Ether].src, self.get_dhcp_option_value(options, 'message-type'),
+                              hostname, self.get_dhcp_option_value(options, 'requested_addr'), monotonic(), iface)
+        self.handle_dhcp_request(request)
 
-        logging.info('DHCP request from %s for %s', mac_addr, ip)
-        device = data.get_device_by_mac_addr(mac_addr, self.virtual_mac)
-        if not device:
-            logging.info('This isn\'t a device I know about... Adding it to the database')
-            data.insert_device(mac_addr, hostname)
+    def handle_dhcp_request(self, request):
+        """Handles a parsed DHCP packet from any capture backend"""
+        detection = self.detector.from_dhcp(request)
+        if detection:
+            self.handle_detection(detection)
+
+    def handle_detection(self, detection):
+        """Handles a sign that a device just showed up, from any capture backend.
+
+        This runs on a capture thread, so it only queues the detection for the resolver workers.
+        The MAC cooldown is shared by every signal and interface, so a device that's seen
+        several ways (say a gratuitous ARP, then a DHCP REQUEST) is only handled once, for
+        whichever came first.
+        """
+        metrics.incr('detections_' + detection.signal.replace('-', '_'))
+        if not self.mac_cooldown.allow(detection.mac_addr):
+            logging.debug('Ignoring repeat %s from %s on %s', detection.signal, detection.mac_addr,
+                          detection.iface or 'any interface')
             return
+        if not self.resolvers.submit(detection):
+            # Dropped, so let the device's retries through instead of losing the arrival
+            self.mac_cooldown.forget(detection.mac_addr)
 
-        if self.last_entrance[0] is not None and self.last_entrance[0].name == device.owner.name:
-            logging.info('%s was the last person to enter. Has enough time passed to go again?', device.owner.name)
-            now = datetime.now()
-            elapsed = (now - self.last_entrance[1]).seconds
-            logging.info('Elapsed time since %s entered: %d seconds', device.owner.name, elapsed)
-            if self.last_entrance[1] is not None and (now - self.last_entrance[1]).seconds < 30:
-                logging.info('Nope. Hasn\'t been long enough')
+    def process_request(self, request):
+        """Looks up who sent a Detection and queues their song. Runs on a resolver worker."""
+        mac_addr = request.mac_addr
+        hostname = request.hostname
+        ip = request.requested_addr
+
+        arrival = Arrival(request.received_at)
+        arrival.mark('resolver_queue_wait')
+
+        logging.info('%s from %s for %s%s', request.signal, mac_addr, ip,
+                     ' on ' + request.iface if request.iface else '')
+        device = data.lookup_device(mac_addr, self.virtual_mac)
+        arrival.mark('device_lookup')
+        if not device:
+            metrics.incr('unknown_devices')
+            if request.signal != SIGNAL_DHCP_REQUEST:
+                # Only DHCP REQUESTs add new devices. Don't let anything else keep a cooldown
+                # going that would hide the REQUEST from us.
+                self.mac_cooldown.forget(mac_addr)
                 return
-            self.last_entrance = (device.owner, now)
-        else:
-            now = datetime.now()
-            self.last_entrance = (device.owner, now)
+            if data.device_writer.add(mac_addr, hostname):
+                logging.info('This isn\'t a device I know about... Adding it to the database')
+            return
+
+        log_arrival = partial(data.arrival_writer.add, device.owner.name, device.mac_address, signal=request.signal,
+                              iface=request.iface, arrived_at=datetime.now())
+        if not self.owner_cooldown.allow(device.owner.name):
+            logging.info('%s was just here %d seconds ago. Not playing their song again yet', device.owner.name,
+                         self.owner_cooldown.window - self.owner_cooldown.remaining(device.owner.name))
+            log_arrival('cooldown')
+            return
 
         if device.owner.song:
             song = random.choice(device.owner.song)
@@ -74,13 +276,34 @@ class EntranceController(object):
             logging.info('################################################################################')
         else:
             logging.info('Device owner %s doesn\'t have a song. Doing nothing...', device.owner.name)
+            log_arrival('no_song')
             return
 
-        uri, _ = self.player.search(song.artist, song.title)
-        if uri:
-            self.player.queue_song(uri, duration=song.duration, start_minute=song.start_minutes, start_second=song.start_seconds)
+        # On a cache miss, queue the song right away and let the player fade out the old
+        # music while the search runs
+        if self.search_cache.get(song.artist, song.title):
+            uri = self._search(song.artist, song.title)
+            arrival.mark('search')
         else:
+            # Time the search when it's actually done, without moving the arrival's stage
+            # clock out from under the player
+            search_started = monotonic()
+            uri = self.player.executor.submit(self._search, song.artist, song.title)
+            uri.add_done_callback(lambda _: metrics.observe('search', monotonic() - search_started))
+        metrics.incr('arrivals')
+        metrics.incr('arrivals_by_' + request.signal.replace('-', '_'))
+        arrival.on_finish = lambda latency: log_arrival('played', latency=latency)
+        # Only the first player's copy logs the arrival
+        for i, player in enumerate(self.players_for(request.iface, device.owner.name)):
+            player.queue_song(uri, duration=song.duration, start_minute=song.start_minutes,
+                              start_second=song.start_seconds, arrival=arrival if i == 0 else arrival.fork())
+
+    def _search(self, artist, title):
+        """Gets the URI for a song, or None if the search didn't find anything"""
+        uri, _ = self.search_cache.resolve(artist, title)
+        if not uri:
             logging.info('No search results found...')
+        return uri
 
     def playback(self):
         pass
@@ -89,7 +312,15 @@ class EntranceController(object):
         # Begin playing the new track
         # wait for the thread to complete
 
+def zone_arg(spec):
+    """Parses a --zone argument"""
+    try:
+        return parse_zone(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
 def main():
+    started = monotonic()
     logging.basicConfig(level=logging.INFO, format='[%(asctime)s %(levelname)s] %(message)s',
                         datefmt='%Y %b %d %H:%M:%S')
     logging.info('Starting entrance song application')
@@ -98,6 +329,55 @@ def main():
     parser.add_argument('--volume', dest='default_volume', action='store', default=70, type=int)
     parser.add_argument('--device', dest='device_id', action='store', default=None, type=str)
     parser.add_argument('--virtualmac', dest='virtual_mac', action='store_true')
+    parser.add_argument('--zone', dest='zones', action='append', default=None, type=zone_arg,
+                        help='Play arrivals on an interface or by an owner on these devices, '
+                             'e.g. iface:wlan-guest=DEVICE_ID or owner:Austin=DEVICE_ID,DEVICE_ID@ACCOUNT')
+    parser.add_argument('--capture', dest='capture', action='store', default='scapy', choices=['scapy', 'raw'],
+                        help='Capture backend. "raw" reads an AF_PACKET socket directly (Linux only)')
+    parser.add_argument('--iface', dest='ifaces', action='append', default=None, type=str,
+                        help='An interface to sniff on. Give it more than once to sniff on several')
+    parser.add_argument('--detect-discover', dest='signals', action='append_const', const=SIGNAL_DHCP_DISCOVER,
+                        help='Also treat a DHCP DISCOVER from a known device as an arrival')
+    parser.add_argument('--detect-arp', dest='signals', action='append_const', const=SIGNAL_ARP,
+                        help='Also treat a gratuitous ARP or ARP probe from a known device as an arrival')
+    parser.add_argument('--detect-ndp', dest='signals', action='append_const', const=SIGNAL_NDP,
+                        help='Also treat an IPv6 duplicate address check from a known device as an arrival')
+    parser.add_argument('--workers', dest='workers', action='store', default=DEFAULT_WORKERS, type=int)
+    parser.add_argument('--queue-size', dest='max_queued', action='store', default=DEFAULT_MAX_QUEUED, type=int)
+    parser.add_argument('--search-ttl', dest='search_ttl', action='store', default=DEFAULT_TTL_HOURS, type=int,
+                        help='Hours to keep cached Spotify search results')
+    parser.add_argument('--no-prewarm', dest='prewarm', action='store_false',
+                        help='Don\'t resolve every song in the database at startup')
+    parser.add_argument('--fade-time', dest='fade_duration', action='store', default=DEFAULT_FADE_DURATION,
+                        type=float, help='Seconds to spend fading music in or out')
+    parser.add_argument('--fade-curve', dest='fade_curve', action='store', default=DEFAULT_CURVE,
+                        choices=sorted(CURVES))
+    parser.add_argument('--busy-clip-limit', dest='busy_clip_limit', action='store', default=None, type=int,
+                        help='Cut songs down to this many seconds when other people are waiting')
+    parser.add_argument('--coalesce', dest='coalesce_window', action='store', default=None, type=float,
+                        help='Play songs for people arriving within this many seconds of each other back to back')
+    parser.add_argument('--mac-cooldown', dest='mac_cooldown', action='store', default=DEFAULT_MAC_WINDOW, type=float,
+                        help='Seconds to ignore more DHCP requests from the same device')
+    parser.add_argument('--owner-cooldown', dest='owner_cooldown', action='store', default=DEFAULT_OWNER_WINDOW,
+                        type=float, help='Seconds before the same person\'s song can play again')
+    parser.add_argument('--cooldown-size', dest='cooldown_size', action='store', default=DEFAULT_MAX_ENTRIES, type=int,
+                        help='How many devices and people to remember for the cooldowns')
+    parser.add_argument('--api-base', dest='api_base', action='store', default=None,
+                        help='Use the Web API at this URL without authenticating, e.g. http://127.0.0.1:8099/v1/ '
+                             'for bin/fakespotify')
+    parser.add_argument('--metrics-port', dest='metrics_port', action='store', default=None, type=int,
+                        help='Serve latency histograms and counters at http://127.0.0.1:<port>/metrics')
+    parser.add_argument('--metrics-log-interval', dest='metrics_log_interval', action='store',
+                        default=metrics_module.DEFAULT_LOG_INTERVAL, type=float,
+                        help='Seconds between metrics summaries in the log, or 0 for none')
+    parser.add_argument('--fast-start', dest='fast_start', action='store_true',
+                        help='Start capturing right away and connect to Spotify in the background')
+    parser.add_argument('--no-db-tuning', dest='db_tuning', action='store_false',
+                        help='Use SQLite\'s default settings instead of WAL mode and a connection pool')
+    parser.add_argument('--predict', dest='predict', action='store_true',
+                        help='Warm up people\'s songs and devices shortly before they usually arrive')
+    parser.add_argument('--predict-lead', dest='predict_lead', action='store', default=DEFAULT_LEAD_MINUTES,
+                        type=float, help='Minutes before someone\'s usual arrival to warm up for them')
     args = parser.parse_args()
 
     if args.default_volume > 100 or args.default_volume < 0:
@@ -112,15 +392,52 @@ def main():
     if args.virtual_mac:
         logging.info('Using virtual MAC address filtering')
 
+    if not args.db_tuning:
+        data.configure(tuned=False)
+
+    if args.metrics_port:
+        metrics_module.start_server(args.metrics_port)
+    if args.metrics_log_interval:
+        metrics_module.start_log_summary(args.metrics_log_interval)
+
+    try:
+        entrance = EntranceController(default_volume=args.default_volume, device_id=args.device_id,
+                                      virtual_mac=args.virtual_mac, capture=args.capture, ifaces=args.ifaces,
+                                      workers=args.workers, max_queued=args.max_queued,
+                                      search_ttl=args.search_ttl, prewarm=args.prewarm,
+                                      fade_duration=args.fade_duration, fade_curve=args.fade_curve,
+                                      busy_clip_limit=args.busy_clip_limit, coalesce_window=args.coalesce_window,
+                                      mac_cooldown=args.mac_cooldown, owner_cooldown=args.owner_cooldown,
+                                      cooldown_size=args.cooldown_size, api_base=args.api_base,
+                                      fast_start=args.fast_start,
+                                      signals=[SIGNAL_DHCP_REQUEST] + (args.signals or []),
+                                      zones=ZoneMap(args.zones or []), predict=args.predict,
+                                      predict_lead=args.predict_lead)
+    except MusicPlayerException as e:
+        logging.error(e.msg)
+        exit(1)
+    except SpotifyException as e:
+        logging.error(e.msg)
+        exit(1)
+
+    logging.info('Ready to capture %.2f seconds after starting', monotonic() - started)
     try:
-        entrance = EntranceController(default_volume=args.default_volume, device_id=args.device_id, virtual_mac=args.virtual_mac)
         entrance.start()
+    except KeyboardInterrupt:
+        if any(player.connect_error for player in entrance.players):
+            # A player couldn't connect in the background and interrupted us. That's the
+            # same as failing at startup, so exit with an error for whatever restarts us.
+            logging.error('Shutting down since Spotify isn\'t connected')
+            exit(1)
+        logging.info('Shutting down')
     except MusicPlayerException as e:
         logging.error(e.msg)
         exit(1)
     except SpotifyException as e:
         logging.error(e.msg)
         exit(1)
+    finally:
+        entrance.stop()
 
 if __name__ == '__main__':
     main()
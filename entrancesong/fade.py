@@ -0,0 +1,103 @@
+"""Volume fades that take a set amount of time.
+
+Instead of fixed volume steps with a fixed sleep in between, a fade picks the volume for
+wherever it is on the clock. Slow volume requests just mean fewer, bigger steps, so a
+fade takes about the same time no matter how fast the Spotify API is.
+
+"""
+from threading import Event
+from time import monotonic
+import logging
+import math
+
+# How long a fade takes, in seconds
+DEFAULT_FADE_DURATION = 3.0
+# Never send volume commands closer together than this, in seconds
+MIN_STEP_INTERVAL = 0.25
+
+# Maps how far along the fade is (0 to 1) to how far along the volume change is (0 to 1)
+CURVES = {
+    'linear': lambda x: x,
+    # Quick at first, then gentle, which sounds smoother for fade outs
+    'ease-out': lambda x: math.sin(x * math.pi / 2),
+    # Gentle at first, then quick
+    'ease-in': lambda x: 1 - math.cos(x * math.pi / 2),
+}
+DEFAULT_CURVE = 'linear'
+
+
+class Fader(object):
+    """Fades the volume from one level to another over a set amount of time."""
+    def __init__(self, set_volume, duration=DEFAULT_FADE_DURATION, curve=DEFAULT_CURVE,
+                 min_interval=MIN_STEP_INTERVAL):
+        """Constructor
+        Args
+            set_volume - Called with each new volume. Its run time is used to space out steps.
+            duration - How long a fade takes, in seconds
+            curve - The name of a curve in CURVES
+            min_interval - The least time between volume commands, in seconds
+        """
+        if curve not in CURVES:
+            raise ValueError('Unknown fade curve {}'.format(curve))
+        self.set_volume = set_volume
+        self.duration = duration
+        self.curve = CURVES[curve]
+        self.min_interval = min_interval
+        # Running average of how long a volume command takes
+        self.latency = 0.0
+        self._cancelled = Event()
+
+    def cancel(self):
+        """Stops the fade that's running, leaving the volume wherever it got to"""
+        self._cancelled.set()
+
+    def _send(self, volume, set_volume):
+        started = monotonic()
+        set_volume(volume)
+        elapsed = monotonic() - started
+        self.latency = elapsed if not self.latency else (self.latency * 0.7 + elapsed * 0.3)
+
+    def fade(self, start, end, duration=None, set_volume=None):
+        """Fades from start to end.
+
+        Args:
+            start - The volume to start at, in percent
+            end - The volume to finish at, in percent
+            duration - How long to take, in seconds, or None for the default
+            set_volume - Called with each new volume for just this fade, instead of the one
+                given to the constructor
+
+        Returns the number of volume commands sent, or None if the fade was cancelled
+        """
+        self._cancelled.clear()
+        duration = self.duration if duration is None else duration
+        set_volume = set_volume or self.set_volume
+        start, end = int(start), int(end)
+        if start == end:
+            return 0
+
+        steps = 0
+        last = None
+        began = monotonic()
+        while True:
+            step_started = monotonic()
+            progress = 1.0 if duration <= 0 else min(1.0, (step_started - began) / duration)
+            volume = int(round(start + (end - start) * self.curve(progress)))
+            if volume != last:
+                self._send(volume, set_volume)
+                last = volume
+                steps += 1
+            if progress >= 1.0:
+                break
+
+            # Space steps out by at least as long as a volume command takes, but don't
+            # overshoot the end
+            now = monotonic()
+            wait = step_started + max(self.min_interval, self.latency) - now
+            wait = max(0, min(wait, began + duration - now))
+            if self._cancelled.wait(wait):
+                logging.info('Fade cancelled at volume %s', last)
+                return None
+
+        logging.debug('Faded from %d to %d in %.2f seconds with %d steps', start, end, monotonic() - began, steps)
+        return steps
@@ -0,0 +1,372 @@
+"""A local stand-in for the Spotify Web API.
+
+Implements just the endpoints the player uses, keeps track of what's playing, counts
+calls, and can be told to answer slowly or with 429 rate-limit errors. Run it with
+bin/fakespotify and point the controller at it with --api-base.
+
+"""
+import argparse
+from collections import Counter, deque
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock
+from time import monotonic, sleep, time
+from urllib.parse import urlparse, parse_qs
+import json
+import logging
+import random
+
+DEFAULT_PORT = 8099
+TRACK_LENGTH_MS = 200000
+ALBUM_LENGTH = 12
+# How many volume changes to remember for /stats
+VOLUME_HISTORY = 500
+
+
+def _fake_id(text):
+    return md5(text.encode('utf-8')).hexdigest()[:22]
+
+
+def _track(track_id, name=None, album_id=None, track_number=1):
+    album_id = album_id or _fake_id('album ' + track_id)
+    return {
+        'id': track_id,
+        'uri': 'spotify:track:' + track_id,
+        'name': name or 'Track ' + track_id,
+        'duration_ms': TRACK_LENGTH_MS,
+        'track_number': track_number,
+        'disc_number': 1,
+        'album': {'id': album_id, 'uri': 'spotify:album:' + album_id, 'name': 'Album ' + album_id},
+    }
+
+
+class FakePlayer(object):
+    """Playback state for the fake server"""
+    def __init__(self):
+        self.lock = Lock()
+        self.devices = [
+            {'id': 'fake-speaker', 'name': 'Fake Speaker', 'type': 'Speaker', 'is_active': True,
+             'is_restricted': False, 'volume_percent': 60},
+            {'id': 'fake-laptop', 'name': 'Fake Laptop', 'type': 'Computer', 'is_active': False,
+             'is_restricted': False, 'volume_percent': 40},
+        ]
+        album_id = _fake_id('background album')
+        self.context = {'type': 'album', 'uri': 'spotify:album:' + album_id}
+        self.item = _track(_fake_id('background track 3'), 'Background', album_id, 3)
+        self.is_playing = True
+        self.progress_ms = 30000
+        self.progress_at = monotonic()
+
+    def device(self, device_id=None):
+        """Gets a device by ID, or the active one"""
+        for device in self.devices:
+            if (device_id and device['id'] == device_id) or (not device_id and device['is_active']):
+                return device
+        return None
+
+    def activate(self, device_id):
+        for device in self.devices:
+            device['is_active'] = device['id'] == device_id
+
+    def progress(self):
+        if not self.is_playing:
+            return self.progress_ms
+        return min(self.item['duration_ms'], self.progress_ms + int((monotonic() - self.progress_at) * 1000))
+
+    def set_progress(self, progress_ms):
+        self.progress_ms = progress_ms
+        self.progress_at = monotonic()
+
+    def playback(self):
+        device = self.device()
+        if not device:
+            return None
+        return {
+            'device': dict(device),
+            'is_playing': self.is_playing,
+            'progress_ms': self.progress(),
+            'timestamp': int(time() * 1000),
+            'context': dict(self.context) if self.context else None,
+            'item': self.item,
+            'currently_playing_type': 'track',
+        }
+
+
+class FakeSpotifyServer(ThreadingMixIn, HTTPServer):
+    """HTTP server holding the fake player, the call counts and the fault settings"""
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, rate_limit=None, error_rate=0.0):
+        """Constructor
+        Args
+            address - (host, port) to listen on
+            latency - Seconds to wait before answering each request
+            jitter - Up to this many extra seconds, picked at random per request
+            rate_limit - Answer 429 when more than this many requests come in within a second
+            error_rate - Fraction of requests to answer with 429 regardless
+        """
+        HTTPServer.__init__(self, address, FakeSpotifyHandler)
+        self.player = FakePlayer()
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.stats_lock = Lock()
+        self.calls = Counter()
+        self.rate_limited = 0
+        self.recent = deque()
+        self.volume_history = deque(maxlen=VOLUME_HISTORY)
+
+    def should_rate_limit(self):
+        """Records a request and decides whether to answer it with a 429"""
+        now = monotonic()
+        with self.stats_lock:
+            self.recent.append(now)
+            while self.recent and now - self.recent[0] > 1.0:
+                self.recent.popleft()
+            limited = (self.rate_limit is not None and len(self.recent) > self.rate_limit) or \
+                random.random() < self.error_rate
+            if limited:
+                self.rate_limited += 1
+            return limited
+
+    def count(self, endpoint):
+        with self.stats_lock:
+            self.calls[endpoint] += 1
+
+    def stats(self):
+        with self.stats_lock:
+            return {'calls': dict(self.calls), 'total': sum(self.calls.values()), 'rate_limited': self.rate_limited,
+                    'volume_history': list(self.volume_history)}
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.calls.clear()
+            self.rate_limited = 0
+            self.volume_history.clear()
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    """Routes requests to the fake endpoints"""
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s', self.address_string(), format % args)
+
+    def _send(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if payload:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if payload:
+            self.wfile.write(payload)
+
+    def _error(self, status, message):
+        self._send(status, {'error': {'status': status, 'message': message}})
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            return {}
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+        if path.startswith('/v1'):
+            path = path[3:]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if path == '/stats':
+            if method == 'DELETE':
+                self.server.reset_stats()
+                return self._send(204)
+            return self._send(200, self.server.stats())
+
+        endpoint = '{} {}'.format(method, path if not path.startswith('/albums/') else '/albums/{id}/tracks')
+        body = self._body() if method in ('PUT', 'POST') else {}
+
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            sleep(delay)
+        if server.should_rate_limit():
+            return self._send(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                              {'Retry-After': '1'})
+        server.count(endpoint)
+
+        route = ROUTES.get((method, path))
+        if route is None and method == 'GET' and path.startswith('/albums/') and path.endswith('/tracks'):
+            route = FakeSpotifyHandler.album_tracks
+        if route is None:
+            return self._error(404, 'Service not found')
+        with server.player.lock:
+            return route(self, server.player, query, body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    # Endpoints. Each is called with the player locked.
+
+    def search(self, player, query, body):
+        q = query.get('q', '')
+        limit = int(query.get('limit', 10))
+        items = [_track(_fake_id('{} {}'.format(q, i)), q if i == 0 else '{} ({})'.format(q, i)) for i in range(limit)]
+        return self._send(200, {'tracks': {'items': items, 'total': limit, 'limit': limit, 'offset': 0, 'next': None}})
+
+    def tracks(self, player, query, body):
+        ids = [i for i in query.get('ids', '').split(',') if i]
+        return self._send(200, {'tracks': [_track(i) for i in ids]})
+
+    def album_tracks(self, player, query, body):
+        album_id = self.path.split('/albums/')[1].split('/')[0]
+        items = [_track(_fake_id('{} {}'.format(album_id, n)), None, album_id, n) for n in range(1, ALBUM_LENGTH + 1)]
+        return self._send(200, {'items': items, 'total': len(items), 'next': None})
+
+    def devices(self, player, query, body):
+        return self._send(200, {'devices': [dict(d) for d in player.devices]})
+
+    def current_playback(self, player, query, body):
+        playback = player.playback()
+        if not playback:
+            return self._send(204)
+        return self._send(200, playback)
+
+    def currently_playing(self, player, query, body):
+        return self.current_playback(player, query, body)
+
+    def _target(self, player, query):
+        device_id = query.get('device_id')
+        device = player.device(device_id)
+        if not device:
+            self._error(404, 'Device not found' if device_id else 'No active device found')
+        return device
+
+    def play(self, player, query, body):
+        device = self._target(player, query)
+        if not device:
+            return
+        player.activate(device['id'])
+        offset = body.get('offset') or {}
+        position_ms = body.get('position_ms') or 0
+        if body.get('uris'):
+            player.context = None
+            player.item = _track(body['uris'][0].split(':')[-1])
+        elif body.get('context_uri'):
+            context_uri = body['context_uri']
+            if ':artist:' in context_uri and offset:
+                return self._error(400, 'Can\'t have offset for context type: ARTIST')
+            album_id = context_uri.split(':')[-1]
+            number = 1
+            if 'position' in offset:
+                number = int(offset['position']) + 1
+            if 'uri' in offset:
+                track_id = offset['uri'].split(':')[-1]
+            else:
+                track_id = _fake_id('{} {}'.format(album_id, number))
+            player.context = {'type': 'album', 'uri': context_uri}
+            player.item = _track(track_id, None, album_id, number)
+        player.is_playing = True
+        player.set_progress(position_ms)
+        return self._send(204)
+
+    def pause(self, player, query, body):
+        if not self._target(player, query):
+            return
+        player.set_progress(player.progress())
+        player.is_playing = False
+        return self._send(204)
+
+    def volume(self, player, query, body):
+        device = self._target(player, query)
+        if not device:
+            return
+        volume = int(query.get('volume_percent', 0))
+        device['volume_percent'] = max(0, min(100, volume))
+        self.server.volume_history.append((round(time(), 3), device['id'], device['volume_percent']))
+        return self._send(204)
+
+    def transfer(self, player, query, body):
+        device_ids = body.get('device_ids') or []
+        if not device_ids or not player.device(device_ids[0]):
+            return self._error(404, 'Device not found')
+        player.activate(device_ids[0])
+        if body.get('play'):
+            player.is_playing = True
+            player.set_progress(player.progress_ms)
+        return self._send(204)
+
+    def next_track(self, player, query, body):
+        number = player.item.get('track_number', 1) + 1
+        album_id = player.item['album']['id']
+        player.item = _track(_fake_id('{} {}'.format(album_id, number)), None, album_id, number)
+        player.set_progress(0)
+        return self._send(204)
+
+    def seek(self, player, query, body):
+        player.set_progress(int(query.get('position_ms', 0)))
+        return self._send(204)
+
+
+ROUTES = {
+    ('GET', '/search'): FakeSpotifyHandler.search,
+    ('GET', '/tracks'): FakeSpotifyHandler.tracks,
+    ('GET', '/me/player/devices'): FakeSpotifyHandler.devices,
+    ('GET', '/me/player'): FakeSpotifyHandler.current_playback,
+    ('GET', '/me/player/currently-playing'): FakeSpotifyHandler.currently_playing,
+    ('PUT', '/me/player/play'): FakeSpotifyHandler.play,
+    ('PUT', '/me/player/pause'): FakeSpotifyHandler.pause,
+    ('PUT', '/me/player/volume'): FakeSpotifyHandler.volume,
+    ('PUT', '/me/player'): FakeSpotifyHandler.transfer,
+    ('POST', '/me/player/next'): FakeSpotifyHandler.next_track,
+    ('PUT', '/me/player/seek'): FakeSpotifyHandler.seek,
+}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s %(levelname)s] %(message)s',
+                        datefmt='%Y %b %d %H:%M:%S')
+
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the Spotify Web API')
+    parser.add_argument('--host', dest='host', action='store', default='127.0.0.1')
+    parser.add_argument('--port', dest='port', action='store', default=DEFAULT_PORT, type=int)
+    parser.add_argument('--latency', dest='latency', action='store', default=0.0, type=float,
+                        help='Seconds to wait before answering each request')
+    parser.add_argument('--jitter', dest='jitter', action='store', default=0.0, type=float,
+                        help='Up to this many extra seconds of random latency per request')
+    parser.add_argument('--rate-limit', dest='rate_limit', action='store', default=None, type=int,
+                        help='Answer 429 above this many requests per second')
+    parser.add_argument('--error-rate', dest='error_rate', action='store', default=0.0, type=float,
+                        help='Fraction of requests to answer with 429 anyway')
+    args = parser.parse_args()
+
+    server = FakeSpotifyServer((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                               rate_limit=args.rate_limit, error_rate=args.error_rate)
+    logging.info('Fake Spotify API listening on http://%s:%d/v1/ (call counts at /stats)', args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info('Calls: %s', json.dumps(server.stats()['calls'], sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
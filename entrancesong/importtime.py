@@ -0,0 +1,74 @@
+"""Reports how long importing the controller takes, module by module.
+
+Imports happen in a fresh interpreter run with -X importtime, so nothing is cached from
+this one. Use --budget to fail when startup gets slower than it should be, and --forbid
+to fail when a module we went out of our way not to load (like scapy.all) sneaks back in.
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+DEFAULT_MODULE = 'entrancesong.entrance'
+DEFAULT_FORBIDDEN = ['scapy.all']
+DEFAULT_TOP = 15
+
+
+def measure(module=DEFAULT_MODULE):
+    """Imports a module in a new interpreter.
+
+    Returns a list of (name, self_us, cumulative_us, depth) in import order
+    """
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=root,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError('Could not import {}:\n{}'.format(module, '\n'.join(errors)))
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reports how long importing the controller takes')
+    parser.add_argument('--module', dest='module', action='store', default=DEFAULT_MODULE)
+    parser.add_argument('--top', dest='top', action='store', default=DEFAULT_TOP, type=int,
+                        help='How many of the slowest modules to list')
+    parser.add_argument('--budget', dest='budget', action='store', default=None, type=float,
+                        help='Fail if the import takes longer than this many seconds')
+    parser.add_argument('--forbid', dest='forbidden', action='append', default=None,
+                        help='Fail if this module gets imported. Defaults to scapy.all')
+    args = parser.parse_args()
+
+    imports = measure(args.module)
+    total = next((cumulative for name, _, cumulative, _ in imports if name == args.module), 0) / 1e6
+    by_name = {name: (self_us, cumulative) for name, self_us, cumulative, _ in imports}
+
+    print('Importing {} took {:.3f}s ({} modules)'.format(args.module, total, len(imports)))
+    print()
+    print('{:>10} {:>10}  {}'.format('self (s)', 'total (s)', 'module'))
+    # Just the top level packages each import pulled in, so one slow package is one line
+    top_level = [i for i in imports if i[3] <= 1]
+    for name, self_us, cumulative, _ in sorted(top_level, key=lambda i: i[2], reverse=True)[:args.top]:
+        print('{:>10.3f} {:>10.3f}  {}'.format(self_us / 1e6, cumulative / 1e6, name))
+
+    failed = False
+    for name in args.forbidden or DEFAULT_FORBIDDEN:
+        if name in by_name:
+            print('\n{} was imported, but shouldn\'t be'.format(name))
+            failed = True
+    if args.budget is not None and total > args.budget:
+        print('\nOver the budget of {:.3f}s'.format(args.budget))
+        failed = True
+    exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""Latency histograms and counters for the arrival path.
+
+Each arrival is timed through its stages (capture, lookup, search, queueing, playback)
+into fixed-bucket histograms, which are cheap enough to update on the hot path. The
+numbers are served as Prometheus-style text from a small HTTP /metrics endpoint and
+summarized in the log every so often.
+
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Event, Lock, Thread
+from time import monotonic
+import logging
+
+# Histogram bucket upper bounds for times, in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Histogram bucket upper bounds for counts
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 10, 15, 20, 30, 50, 100)
+
+DEFAULT_LOG_INTERVAL = 300
+
+
+class Histogram(object):
+    """Counts observations into fixed buckets"""
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, pct):
+        """Gets the upper bound of the bucket the pct'th percentile falls in"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return 0
+        target = total * pct / 100.0
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+def percentile(values, pct):
+    """Gets the pct'th percentile of a list of values, or 0 if it's empty"""
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class StageTimes(object):
+    """Collects every sample of how long each stage took, for reports that need exact
+    percentiles rather than histogram buckets
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.samples = defaultdict(list)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def summary(self):
+        """Returns lines of count and p50/p90/p99/max in ms for each stage"""
+        lines = []
+        for stage, values in self.samples.items():
+            lines.append('  {:<14} n={:<7} p50={:8.3f} p90={:8.3f} p99={:8.3f} max={:8.3f} ms'.format(
+                stage, len(values), *(percentile(values, p) * 1000 for p in (50, 90, 99, 100))))
+        return lines
+
+
+class Metrics(object):
+    """A set of named counters, histograms and gauges"""
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    def observe(self, name, value, buckets=TIME_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram(buckets))
+        histogram.observe(value)
+
+    def gauge(self, name, func):
+        """Registers a function to call for a value whenever metrics are read"""
+        with self._lock:
+            self.gauges[name] = func
+
+    def _gauge_values(self):
+        values = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                values[name] = func()
+            except Exception as e:
+                logging.debug('Could not read gauge %s: %s', name, e)
+        return values
+
+    def render(self):
+        """Renders everything in the Prometheus text format"""
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE entrancesong_{0} counter\nentrancesong_{0} {1}'.format(name, value))
+        for name, value in sorted(self._gauge_values().items()):
+            lines.append('# TYPE entrancesong_{0} gauge\nentrancesong_{0} {1}'.format(name, value))
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append('# TYPE entrancesong_{} histogram'.format(name))
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('entrancesong_{}_bucket{{le="{}"}} {}'.format(name, bound, cumulative))
+            lines.append('entrancesong_{}_bucket{{le="+Inf"}} {}'.format(name, histogram.count))
+            lines.append('entrancesong_{}_sum {}'.format(name, histogram.sum))
+            lines.append('entrancesong_{}_count {}'.format(name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Gets a few lines summarizing everything, for the log"""
+        lines = []
+        counters = dict(self.counters)
+        counters.update(self._gauge_values())
+        if counters:
+            lines.append(', '.join('{}={}'.format(k, v) for k, v in sorted(counters.items())))
+        for name, histogram in sorted(self.histograms.items()):
+            if histogram.count:
+                lines.append('{}: n={} mean={:.3f} p50<={} p90<={} p99<={}'.format(
+                    name, histogram.count, histogram.sum / histogram.count, histogram.percentile(50),
+                    histogram.percentile(90), histogram.percentile(99)))
+        return lines
+
+
+# The metrics for this process
+metrics = Metrics()
+
+
+class Arrival(object):
+    """Times one arrival through its stages. Each mark() records the time since the last
+    one as that stage.
+    """
+    __slots__ = ('received_at', 'last', 'on_finish')
+
+    def __init__(self, received_at=None):
+        now = monotonic()
+        self.received_at = received_at if received_at is not None else now
+        self.last = self.received_at
+        # Called with the total time when the arrival finishes
+        self.on_finish = None
+
+    def fork(self):
+        """Gets a copy to time separately from here on, like when one arrival plays in
+        several places at once. The copy doesn't call on_finish.
+        """
+        arrival = Arrival(self.received_at)
+        arrival.last = self.last
+        return arrival
+
+    def mark(self, stage):
+        now = monotonic()
+        metrics.observe(stage, now - self.last)
+        self.last = now
+
+    def finish(self, name):
+        """Records the time from the packet arriving to now"""
+        elapsed = monotonic() - self.received_at
+        metrics.observe(name, elapsed)
+        if self.on_finish:
+            self.on_finish(elapsed)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics: ' + format, *args)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(port, host='127.0.0.1'):
+    """Serves /metrics on a background thread. Returns the server."""
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info('Serving metrics at http://%s:%d/metrics', host, server.server_address[1])
+    return server
+
+
+def start_log_summary(interval=DEFAULT_LOG_INTERVAL):
+    """Logs a summary of the metrics every interval seconds. Returns an Event that stops it."""
+    stopped = Event()
+
+    def _run():
+        while not stopped.wait(interval):
+            for line in metrics.summary():
+                logging.info('Metrics: %s', line)
+
+    Thread(target=_run, name='metrics-log', daemon=True).start()
+    return stopped
@@ -2,7 +2,7 @@
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, String, Integer, ForeignKey
+from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, UniqueConstraint
 
 DEFAULT_DB = 'sqlite:///entrance_song.db'
 
@@ -14,7 +14,7 @@ class Owner(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False, unique=True)
-    devices = relationship("Device", back_populates="owner", lazy='joined')
+    devices = relationship("Device", back_populates="owner", lazy='select')
     song = relationship("Song", uselist=True, lazy='joined')
 
 class Device(Base):
@@ -25,7 +25,7 @@ class Device(Base):
     mac_address = Column(String, nullable=False, unique=True)
     hostname = Column(String)
     friendly_name = Column(String)
-    owner_id = Column(Integer, ForeignKey('owner.id'))
+    owner_id = Column(Integer, ForeignKey('owner.id'), index=True)
     owner = relationship("Owner", back_populates="devices", lazy='joined')
 
     def __str__(self):
@@ -41,12 +41,46 @@ class Song(Base):
     start_minutes = Column(Integer)
     start_seconds = Column(Integer)
     duration = Column(Integer)
-    owner_id = Column(Integer, ForeignKey('owner.id'))
+    owner_id = Column(Integer, ForeignKey('owner.id'), index=True)
 
     def __str__(self):
         return '{} by {} (starts at {}:{}, {} seconds long)'.format(
             self.title, self.artist, self.start_minutes, self.start_seconds, self.duration)
 
+class SearchResult(Base):
+    """A cached Spotify search result for an artist and title"""
+    __tablename__ = 'search_result'
+    __table_args__ = (UniqueConstraint('artist', 'title'),)
+
+    id = Column(Integer, primary_key=True)
+    artist = Column(String, nullable=False)
+    title = Column(String, nullable=False)
+    uri = Column(String, nullable=False)
+    name = Column(String)
+    duration_ms = Column(Integer)
+    resolved_at = Column(DateTime, nullable=False)
+
+    def __str__(self):
+        return '{} - {} -> {} ({})'.format(self.artist, self.title, self.uri, self.resolved_at)
+
+class ArrivalLog(Base):
+    """Someone arriving, and what we did about it. Rows are only ever added."""
+    __tablename__ = 'arrival'
+
+    id = Column(Integer, primary_key=True)
+    owner_name = Column(String, nullable=False)
+    mac_address = Column(String, nullable=False)
+    signal = Column(String)
+    iface = Column(String)
+    arrived_at = Column(DateTime, nullable=False, index=True)
+    # What happened: played, cooldown or no_song
+    outcome = Column(String, nullable=False)
+    # From the packet arriving to the music starting, if it played
+    latency_ms = Column(Integer)
+
+    def __str__(self):
+        return '{} ({}) at {}: {}'.format(self.owner_name, self.mac_address, self.arrived_at, self.outcome)
+
 
 if __name__ == '__main__':
     from sqlalchemy import create_engine
@@ -1,29 +1,61 @@
 """Code for playing music on spotify."""
 
-from queue import Queue
-from threading import Thread
-from time import sleep
+import _thread
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Event, Lock, Thread, Timer
+from time import sleep, monotonic, time
 from datetime import datetime, timedelta
+from functools import partial
 import logging
 
+import requests
 import spotipy
 import spotipy.util
 from spotipy.client import SpotifyException
 
+from .fade import Fader, DEFAULT_FADE_DURATION, DEFAULT_CURVE
+from .metrics import metrics, COUNT_BUCKETS
+
 SEARCH_LIMIT = 20
 SPOTIPY_USER_NAME = 'spotipy_user'
 
 # The default volume to set things to, in percent
 DEFAULT_VOLUME = 50
-FADE_DELTA=5
+
+# How long a playback snapshot can be used before asking Spotify again, in seconds
+PLAYBACK_TTL = 2.0
 
 SCOPE = 'streaming user-read-playback-state user-read-currently-playing'
 
+# Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 300
+# How many connections to keep open to the Spotify API
+HTTP_POOL_SIZE = 8
+
+
+def make_http_session():
+    """Builds a requests session that keeps connections to the Spotify API open"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(_count_api_call)
+    return session
+
+
+def _count_api_call(response, *args, **kwargs):
+    metrics.incr('spotify_api_calls')
+    if response.status_code == 429:
+        metrics.incr('spotify_rate_limited')
+
 class MusicThread(Thread):
-    """A thread to start music and sleep. This is a cheap way to implement playing
+    """A thread to start music and wait. This is a cheap way to implement playing
     a duration of a song since the Spotify API doesn't include that.
+
+    The wait can be cut short with limit() or preempt().
     """
-    def __init__(self, sp_context, mp_context, uri, position_ms, duration=45, device_id=None):
+    def __init__(self, sp_context, mp_context, uri, position_ms, duration=45, device_id=None, arrival=None):
         """Constructor
         Args
             sp_context - The spotify context
@@ -32,6 +64,7 @@ class MusicThread(Thread):
             position_ms - The position in ms to start from
             duration - The duration to play, in seconds
             device_id - The device to play on, or None to play on the default device
+            arrival - The Arrival to time, if any
         """
         super().__init__()
 
@@ -41,6 +74,39 @@ class MusicThread(Thread):
         self.position_ms = position_ms
         self.duration = duration
         self.device_id = device_id
+        self.arrival = arrival
+
+        self._lock = Lock()
+        self._wake = Event()
+        self._clip_started = None
+        self._clip_end = None
+        self._limit = None
+
+    def limit(self, seconds):
+        """Caps how long the clip plays, counting from when it started. If it's already
+        played that long, it stops now. Never makes the clip longer.
+        """
+        with self._lock:
+            if self._limit is None or seconds < self._limit:
+                self._limit = seconds
+            self._wake.set()
+
+    def preempt(self):
+        """Stops the clip now"""
+        self.limit(0)
+
+    def _wait(self):
+        """Waits until the clip's time is up or it's been cut short"""
+        while True:
+            with self._lock:
+                end = self._clip_end
+                if self._limit is not None:
+                    end = min(end, self._clip_started + self._limit)
+                self._wake.clear()
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return
+            self._wake.wait(remaining)
 
     def run(self):
         """Runs the thread.
@@ -48,30 +114,37 @@ class MusicThread(Thread):
         """
         logging.info('Starting playback in new thread')
         try:
-            self.sp.pause_playback()
+            self.mp.pause_playback(device_id=self.device_id)
         except SpotifyException as e:
             # This often happens if there is no current active device. We'll assume there's
             # device_id being used. The next try/catch block will handle it if not.
             pass
         try:
-            self.sp.start_playback(device_id=self.device_id, uris=[self.uri], position_ms=self.position_ms)
+            self.mp.start_playback(device_id=self.device_id, uris=[self.uri], position_ms=self.position_ms)
         except SpotifyException as e:
             logging.error(e)
             return
-        self.mp.set_volume(self.mp.default_volume)
-
-        logging.info('Putting the thread to sleep for %s seconds', self.duration)
-        sleep(self.duration)
+        if self.arrival:
+            self.arrival.mark('start_playback')
+            self.arrival.finish('door_to_music')
+        self.mp.set_volume(self.mp.default_volume, device_id=self.device_id)
+
+        with self._lock:
+            self._clip_started = monotonic()
+            self._clip_end = self._clip_started + self.duration
+        logging.info('Waiting %s seconds for the clip to finish', self.duration)
+        self._wait()
         logging.info('Stopping playback')
 
         # Get the currently playing tack to be sure we're stopping this track and not
         # someone else's.
-        current_track = self.sp.currently_playing()
+        current_track = self.mp.get_playback()
         try:
             uri = current_track['item']['uri']
-            if uri == self.uri:
-                self.mp.fade_out()
-                self.sp.pause_playback()
+            device_id = (current_track.get('device') or {}).get('id')
+            if uri == self.uri and (not self.device_id or device_id == self.device_id):
+                self.mp.fade_out(device_id=self.device_id)
+                self.mp.pause_playback(device_id=self.device_id)
             else:
                 logging.info('Attempted to stop song %s but it\'s not playing', self.uri)
         finally:
@@ -97,43 +170,170 @@ class MusicPlayer(Thread):
         """
         def foo(*args, **kwargs):
             logging.debug('Checking if token is still good')
-
             myself = args[0]
-            auth = myself.sp_auth
+            myself.wait_until_connected()
 
-            token_info = auth.get_cached_token()
-            if token_info['access_token'] != myself.token:
-                new_token = token_info['access_token']
-                logging.debug('Re-building sp')
-                myself.sp = spotipy.Spotify(auth=new_token)
-                myself.token = new_token
+            # The refresh timer normally gets to it first. This only catches the case
+            # where it didn't (e.g. the machine was asleep).
+            expires_at = myself.token_info.get('expires_at')
+            if expires_at and time() > expires_at - 60:
+                myself.refresh_token()
 
             return func(*args, **kwargs)
         return foo
 
-    def __init__(self, default_volume=70, device_id=None):
-        super().__init__()
-        logging.info('Constructing music player... might need to authenticate')
-        token, sp_auth = spotipy.util.prompt_for_user_token(SPOTIPY_USER_NAME, SCOPE)
-        self.sp = spotipy.Spotify(auth=token)
+    def __init__(self, default_volume=70, device_id=None, fade_duration=DEFAULT_FADE_DURATION, fade_curve=DEFAULT_CURVE,
+                 busy_clip_limit=None, coalesce_window=None, spotify_client=None, api_base=None, connect=True,
+                 username=SPOTIPY_USER_NAME, device_only=False, account_lock=None):
+        """Constructor
+        Args
+            default_volume - The volume to play entrance songs at, in percent
+            device_id - The device to play on, or None for the active device
+            fade_duration - How long fades take, in seconds
+            fade_curve - The name of the fade curve
+            busy_clip_limit - If set, a clip that's playing while other songs are queued is cut
+                down to this many seconds
+            coalesce_window - If set, songs queued within this many seconds of each other play
+                back to back, with one fade out before and one restore after
+            spotify_client - A ready to use client to play through instead of authenticating
+                (e.g. a stand-in for benchmarks). Tokens aren't managed for it.
+            api_base - If set, talk to the Web API at this URL (e.g. bin/fakespotify) instead of
+                Spotify's, without authenticating
+            connect - If true, authenticate and check the device now. Otherwise the player
+                thread does it when it starts, and songs queued before then wait for it.
+            username - The account to authenticate as, which names its token cache
+            device_only - If true, only fade out, save and restore music that's playing on
+                device_id, and leave the account's other devices alone (for zones)
+            account_lock - A Lock shared by every player on the same account, so they take
+                turns playing instead of fading out each other's songs
+        """
+        super().__init__(daemon=True)
+        self.api_base = api_base
+        self.spotify_client = spotify_client
+        self.username = username
+        # Every client we build shares this session, so a new token doesn't mean new connections
+        self.http = make_http_session()
+        self.sp = None
+        self.sp_auth = None
+        self.token = None
+        self.token_info = {}
+        self._token_lock = Lock()
+        self._refresh_timer = None
+        # Set once connect() has finished, whether or not it worked
+        self.connected = Event()
+        self.connect_error = None
 
         self.song_queue = Queue()
+        # Runs the work that can overlap with fading out the current music
+        self.executor = ThreadPoolExecutor(max_workers=4)
 
         self.original_playback = None
         self.original_volume = None
-        self.sp_auth = sp_auth
-        self.token = token
+        # Album URI -> track URIs, for restoring playback in the middle of an album
+        self._album_tracks = {}
+        # The last thing current_playback returned, kept up to date with our own commands
+        self._playback = None
+        self._playback_time = None
+        self._playback_lock = Lock()
         self.default_volume = default_volume
-
-        # If a device ID was provided, make sure it exists before we attempt to use it
-        if device_id:
-            logging.info('Making sure device %s actually exists', device_id)
-            if not self._check_device(device_id):
-                raise MusicPlayerException('Could not find device ID %s' % device_id)
+        self.fader = Fader(self.set_volume, duration=fade_duration, curve=fade_curve)
+        self.busy_clip_limit = busy_clip_limit
+        self.coalesce_window = coalesce_window
+        # Songs taken off the queue that haven't been played yet
+        self.pending = []
+        self.running = True
+        self.current_thread = None
+        self._current_lock = Lock()
         self.device_id = device_id
-
+        self.device_only = device_only and bool(device_id)
+        self.account_lock = account_lock or Lock()
         self.token_refresh_datetime = datetime.now()
 
+        if connect:
+            self.connect()
+
+    def connect(self):
+        """Authenticates with Spotify and makes sure the device we were given exists.
+
+        Raises MusicPlayerException if the device can't be found
+        """
+        try:
+            if self.spotify_client:
+                self.sp = self.spotify_client
+            elif self.api_base:
+                logging.info('Using the Web API at %s without authenticating', self.api_base)
+                self.token = 'local'
+                self.sp = self._make_client(self.token)
+            else:
+                logging.info('Connecting to Spotify... might need to authenticate')
+                self.token, self.sp_auth = spotipy.util.prompt_for_user_token(self.username, SCOPE)
+                self.sp = self._make_client(self.token)
+            self.token_info = (self.sp_auth.get_cached_token() if self.sp_auth else None) or \
+                {'access_token': self.token}
+
+            # If a device ID was provided, make sure it exists before we attempt to use it
+            if self.device_id:
+                logging.info('Making sure device %s actually exists', self.device_id)
+                if not self._check_device(self.device_id):
+                    raise MusicPlayerException('Could not find device ID %s' % self.device_id)
+
+            self.token_refresh_datetime = datetime.now()
+            self._schedule_token_refresh()
+        except Exception as e:
+            self.connect_error = e
+            raise
+        finally:
+            self.connected.set()
+
+    def wait_until_connected(self):
+        """Blocks until connect() has finished. Raises MusicPlayerException if it failed."""
+        self.connected.wait()
+        if self.connect_error:
+            raise MusicPlayerException('Not connected to Spotify: %s' % self.connect_error)
+
+    def _make_client(self, token):
+        """Builds a Spotify client on our shared HTTP session"""
+        sp = spotipy.Spotify(auth=token, requests_session=self.http)
+        if self.api_base:
+            sp.prefix = self.api_base.rstrip('/') + '/'
+        return sp
+
+    def _schedule_token_refresh(self):
+        """Starts a timer to refresh the token a little before it expires"""
+        expires_at = self.token_info.get('expires_at')
+        if not expires_at:
+            return
+        delay = max(0, expires_at - TOKEN_REFRESH_MARGIN - time())
+        logging.debug('Refreshing the token in %d seconds', delay)
+        self._refresh_timer = Timer(delay, self._refresh_in_background)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh_token()
+        except Exception as e:
+            # Try again in a minute, the token is still good for a while
+            logging.error('Could not refresh the token: %s', e)
+            self._refresh_timer = Timer(60, self._refresh_in_background)
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+
+    def refresh_token(self):
+        """Gets a new access token and points the client at it, keeping its connections"""
+        with self._token_lock:
+            expires_at = self.token_info.get('expires_at')
+            if expires_at and time() < expires_at - TOKEN_REFRESH_MARGIN:
+                # Someone else just refreshed it
+                return
+            logging.info('Refreshing the Spotify token')
+            token_info = self.sp_auth.refresh_access_token(self.token_info['refresh_token'])
+            self.token_info = token_info
+            self.token = token_info['access_token']
+            self.sp = self._make_client(self.token)
+            self.token_refresh_datetime = datetime.now()
+        self._schedule_token_refresh()
+
     def _check_device(self, device_id):
         """Checks if a device exists"""
         devices = self.sp.devices().get('devices', [])
@@ -142,6 +342,36 @@ class MusicPlayer(Thread):
                 return True
         return False
 
+    def _prepare_device(self):
+        """Makes sure the device we're going to play on is still there, and wakes it up if no
+        device is active. If another device is active, playing on ours moves the music over
+        anyway, and transferring now would drag the music that's fading out along with it.
+
+        Returns the device ID to play on, or None to use the active device
+        """
+        if not self.device_id:
+            return None
+        devices = self.sp.devices().get('devices', [])
+        device = next((d for d in devices if d.get('id') == self.device_id), None)
+        if not device:
+            logging.warning('Device %s is gone. Playing on the active device instead', self.device_id)
+            return None
+        if not any(d.get('is_active') for d in devices):
+            logging.info('Activating device %s', self.device_id)
+            self.sp.transfer_playback(device_id=self.device_id, force_play=False)
+            self.invalidate_playback()
+        return self.device_id
+
+    @check_token
+    def warm_device(self):
+        """Gets our device ready ahead of someone showing up, so the first command of their
+        arrival doesn't have to wake it. Does nothing if the account has any playback, even
+        paused, so nobody's session gets moved.
+        """
+        if self.get_playback(max_age=0):
+            return
+        self._prepare_device()
+
     @check_token
     def search(self, artist, title):
         """Searches for a song by artist and title and gets the top result.
@@ -173,9 +403,67 @@ class MusicPlayer(Thread):
         Returns a Spotify object (so it's probably way more than you need)"""
         return self.sp.currently_playing()
 
+    def get_playback(self, max_age=PLAYBACK_TTL):
+        """Gets the current playback state, asking Spotify only if our snapshot is older
+        than max_age seconds. Pass max_age=0 to always ask.
+
+        Returns the current_playback object, or None if nothing is playing
+        """
+        with self._playback_lock:
+            if self._playback_time is not None and monotonic() - self._playback_time <= max_age:
+                return self._playback
+        playback = self.sp.current_playback()
+        with self._playback_lock:
+            self._playback = playback
+            self._playback_time = monotonic()
+        return playback
+
+    def invalidate_playback(self):
+        """Throws away the playback snapshot so the next read asks Spotify"""
+        with self._playback_lock:
+            self._playback_time = None
+
+    def _update_playback(self, device_id=None, **changes):
+        """Applies our own command to the snapshot instead of asking Spotify what happened.
+        The snapshot is copied rather than changed in place since callers may hold on to it.
+
+        Args:
+            device_id - The device the command went to, or None for the active device
+            changes - Top level fields to replace, plus volume_percent for the device
+        """
+        with self._playback_lock:
+            playback = self._playback
+            if not playback:
+                return
+            device = playback.get('device') or {}
+            if device_id and device.get('id') != device_id:
+                # Our command went somewhere else, so we don't know what's active now
+                self._playback_time = None
+                return
+            playback = dict(playback)
+            if 'volume_percent' in changes:
+                playback['device'] = dict(device, volume_percent=changes.pop('volume_percent'))
+            playback.update(changes)
+            self._playback = playback
+
+    def start_playback(self, device_id=None, uris=None, context_uri=None, offset=None, position_ms=None):
+        """Starts playback and updates the snapshot to match"""
+        self.sp.start_playback(device_id=device_id, uris=uris, context_uri=context_uri, offset=offset,
+                               position_ms=position_ms)
+        if uris:
+            self._update_playback(device_id, is_playing=True, item={'uri': uris[0]}, progress_ms=position_ms or 0)
+        else:
+            # We don't know which track of the context is playing now
+            self.invalidate_playback()
+
+    def pause_playback(self, device_id=None):
+        """Pauses playback and updates the snapshot to match"""
+        self.sp.pause_playback(device_id=device_id)
+        self._update_playback(device_id, is_playing=False)
+
     def get_volume(self):
         """Gets the current volume"""
-        playback = self.sp.current_playback()
+        playback = self.get_playback()
         if not playback:
             return 0
 
@@ -189,9 +477,10 @@ class MusicPlayer(Thread):
     def set_volume(self, volume, device_id=None):
         """Sets the volume"""
         self.sp.volume(volume, device_id=device_id)
+        self._update_playback(device_id, volume_percent=volume)
 
     @check_token
-    def _play_song(self, uri, start_time_minute=0, start_time_second=0, duration=30):
+    def _play_song(self, uri, start_time_minute=0, start_time_second=0, duration=30, device_id=None, arrival=None):
         """Plays a song by its URI, while starting it in its own thread.
 
         Args:
@@ -199,6 +488,8 @@ class MusicPlayer(Thread):
             start_time_minutes (number) - How long to skip ahead in the song (minutes)
             start_time_seconds (number) - How long to skip ahead in the song (seconds)
             duration (number) - How long to play the song. If None, plays the whole thing.
+            device_id (string) - The device to play on, or None for the active device
+            arrival (Arrival) - Times the arrival this song is for, if any
 
         Returns the MusicThread created by this method
         """
@@ -207,13 +498,18 @@ class MusicPlayer(Thread):
         logging.info('Playing song {}'.format(uri))
         # Save the currently playing song so we can resume it later
 
-        t = MusicThread(self.sp, self, uri, position, duration, device_id=self.device_id)
+        t = MusicThread(self.sp, self, uri, position, duration, device_id=device_id, arrival=arrival)
         t.start()
         return t
 
-    def fade_out(self, delta=FADE_DELTA):
-        """Fades out the music on the current device, not in a very smart way"""
-        playback = self.sp.current_playback()
+    def fade_out(self, duration=None, device_id=None):
+        """Fades out the music on a device
+
+        Args:
+            duration - How long to take, in seconds, or None for the player's default
+            device_id - The device to fade, or None for the active device
+        """
+        playback = self.get_playback()
 
         if not playback:
             # Likely nothing is playing
@@ -222,35 +518,80 @@ class MusicPlayer(Thread):
         device = playback['device']
         if not device:
             logging.error('Could not get the current device')
+            return
+        if device_id and device.get('id') != device_id:
+            # What's playing is on some other device
+            return
 
-        starting_volume = self.get_volume() # device['volume_percent']
+        starting_volume = device['volume_percent']
         logging.info('Fading out... current volume is {}'.format(starting_volume))
+        self.fader.fade(starting_volume, 0, duration, set_volume=partial(self.set_volume, device_id=device_id))
 
-        while starting_volume > 0:
-            self.sp.volume(starting_volume)
-            sleep(0.5)
-            starting_volume = starting_volume - delta
-            logging.debug('fade to {} '.format(starting_volume))
-
-    def fade_in(self, volume=DEFAULT_VOLUME, delta=FADE_DELTA):
-        """Fades in the music on the current device, not in a very smart way"""
+    def fade_in(self, volume=DEFAULT_VOLUME, duration=None, device_id=None):
+        """Fades in the music on a device
 
-        starting_volume = self.get_volume() # device['volume_percent']
+        Args:
+            volume - The volume to finish at, in percent
+            duration - How long to take, in seconds, or None for the player's default
+            device_id - The device to fade, or None for the active device
+        """
+        starting_volume = self.get_volume() or 0
         logging.info('Fading in... current volume is {}'.format(starting_volume))
+        self.fader.fade(starting_volume, volume, duration, set_volume=partial(self.set_volume, device_id=device_id))
 
-        while starting_volume < volume:
-            self.sp.volume(starting_volume)
-            sleep(0.5)
-            starting_volume = starting_volume + delta
-            logging.debug('fade to {} '.format(starting_volume))
+    def cancel_fade(self):
+        """Stops a fade that's running"""
+        self.fader.cancel()
 
+    def queue_song(self, uri, start_minute=0, start_second=0, duration=30, arrival=None):
+        """Queues a song
 
-    def queue_song(self, uri, start_minute=0, start_second=0, duration=30):
-        """Queues a song"""
+        Args:
+            uri - The URI to play, or a Future that returns it (or None if there's nothing
+                to play). The player fades out the current music while it waits on the Future.
+            arrival - The Arrival to time through playback, if any
+        """
         logging.info('Queueing song %s', uri)
-        self.song_queue.put((uri, start_minute, start_second, duration))
+        self.song_queue.put((uri, start_minute, start_second, duration, arrival))
+        self._apply_busy_limit()
+
+    def _apply_busy_limit(self):
+        """Cuts the current clip short if songs are waiting and the policy says to"""
+        if self.busy_clip_limit is None:
+            return
+        with self._current_lock:
+            t = self.current_thread
+        if t and (self.pending or not self.song_queue.empty()):
+            logging.info('Songs are waiting. Cutting the current clip to %s seconds', self.busy_clip_limit)
+            t.limit(self.busy_clip_limit)
+
+    def stop(self, timeout=None):
+        """Stops the current clip, puts the old music back, and ends the player thread"""
+        self.running = False
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        self.song_queue.put(None)
+        self.cancel_fade()
+        with self._current_lock:
+            t = self.current_thread
+        if t:
+            t.preempt()
+        if self.is_alive():
+            self.join(timeout)
 
     def run(self):
+        if not self.connected.is_set():
+            started = monotonic()
+            try:
+                self.connect()
+            except Exception as e:
+                logging.error('Could not connect to Spotify: %s', getattr(e, 'msg', e))
+                # Same as failing at startup, just later. connect_error tells main to exit
+                # with an error rather than as if it were a Ctrl-C.
+                _thread.interrupt_main()
+                return
+            logging.info('Connected to Spotify in %.1f seconds, %d songs waiting', monotonic() - started,
+                         self.song_queue.qsize())
         self.player_main()
 
 
@@ -260,23 +601,33 @@ class MusicPlayer(Thread):
         Args:
             fade - If true, this fades the song out before saving it
         """
-        # Is there already music playing? If so fade it out
-        playback = self.sp.current_playback()
+        self.original_playback = None
+
+        # Is there already music playing? If so fade it out. Always ask Spotify here since
+        # this is what we'll restore later.
+        playback = self.get_playback(max_age=0)
 
         # This means nothing is playing
         if not playback:
             return
 
-        original_volume = self.get_volume()
+        # Send everything to the device the music is on, since with zones the account's
+        # active device can change under us
+        device = playback.get('device') or {}
+        device_id = device.get('id')
+        if self.device_only and device_id != self.device_id:
+            logging.info('Leaving the music on device %s alone', device_id)
+            return
+        original_volume = device.get('volume_percent', DEFAULT_VOLUME)
 
         if playback.get('is_playing', False):
             logging.info('Fading out old music')
             if fade:
-                self.fade_out()
+                self.fade_out(device_id=device_id)
 
         # Set the volume to the previous level so we're ready to play
-        self.sp.pause_playback()
-        self.set_volume(original_volume)
+        self.pause_playback(device_id=device_id)
+        self.set_volume(original_volume, device_id=device_id)
 
         # sleep for just a second to be sure things caught up
         sleep(1)
@@ -306,43 +657,200 @@ class MusicPlayer(Thread):
 
         if self.original_playback.get('is_playing', False):
             self.sp.transfer_playback(device_id=device_id, force_play=False)
+            self.invalidate_playback()
             sleep(1)
             self.set_volume(0, device_id=device_id)
 
             # Spotify has a a weird underdocumented thing where it can't resume playback of a
             # COLLECTION_ALBUM. I have no clue what that is, but it seems to be if you are playing
-            # something from your saved collections.
-            try:
-                self.sp.start_playback(context_uri=uri, offset={'uri': item.get('uri', '')}, position_ms=position_ms)
-            except spotipy.client.SpotifyException as e:
-                logging.warn('Could not start playback. Maybe this is a COLLECTION_ALBUM?')
-                self.sp.start_playback(context_uri=uri, position_ms=position_ms)
-                #self.sp.pause_playback()
-                i = 0
-                track_number = self.original_playback.get('item', {}).get('track_number', 0)
-                logging.warn('Skipping to track number %d', track_number)
-                while (i + 1) < track_number:
-                    i = i + 1
-                    self.sp.next_track()
-                self.sp.seek_track(position_ms)
-                logging.warn('Done! Maybe try playing the full album next time.')
+            # something from your saved collections. So if the obvious way fails, work down
+            # through other ways of getting back to the same spot.
+            for name, kwargs in self._restore_attempts(context, item, position_ms):
+                try:
+                    self.start_playback(device_id=device_id, **kwargs)
+                    logging.info('Restored playback by %s', name)
+                    break
+                except spotipy.client.SpotifyException as e:
+                    logging.warn('Could not restore playback by %s: %s', name, e)
+            else:
+                logging.error('Could not restore playback')
 
             if fade:
-                self.fade_in(volume=original_volume)
+                self.fade_in(volume=original_volume, device_id=device_id)
+
+
+    def _get_album_tracks(self, album_uri):
+        """Gets the track URIs of an album in order, asking Spotify only the first time"""
+        tracks = self._album_tracks.get(album_uri)
+        if tracks is None:
+            tracks = []
+            results = self.sp.album_tracks(album_uri, limit=50)
+            while results:
+                tracks.extend(t['uri'] for t in results.get('items', []))
+                results = self.sp.next(results) if results.get('next') else None
+            self._album_tracks[album_uri] = tracks
+        return tracks
+
+    def _album_position(self, item):
+        """Gets where a track is on its album, counting from 0 across all discs, or None"""
+        album_uri = (item.get('album') or {}).get('uri')
+        if not album_uri:
+            return None
+        try:
+            return self._get_album_tracks(album_uri).index(item.get('uri'))
+        except (ValueError, SpotifyException):
+            return None
+
+    def _restore_attempts(self, context, item, position_ms):
+        """Generates the ways to get back to a saved track, best first, as (name, start_playback
+        arguments). Each one is only worked out if the one before it failed.
+
+        1. The saved context, at the track's URI
+        2. The saved context, at the track's position on its album (album contexts only)
+        3. The track's album, at the track's position
+        4. Just the track
+        """
+        context_uri = context.get('uri', '')
+        item_uri = item.get('uri', '')
+        yield 'context and track', dict(context_uri=context_uri, offset={'uri': item_uri}, position_ms=position_ms)
+
+        position = self._album_position(item)
+        if position is not None:
+            if context.get('type') == 'album':
+                yield 'context and album position', dict(context_uri=context_uri, offset={'position': position},
+                                                         position_ms=position_ms)
+            album_uri = item['album']['uri']
+            if album_uri != context_uri:
+                yield 'album and position', dict(context_uri=album_uri, offset={'position': position},
+                                                 position_ms=position_ms)
+
+        if item_uri:
+            yield 'track only', dict(uris=[item_uri], position_ms=position_ms)
+
+    def _wait_for_uri(self, uri):
+        """Gets the URI out of a Future, or None if resolving it failed"""
+        if not isinstance(uri, Future):
+            return uri
+        try:
+            return uri.result()
+        except Exception as e:
+            logging.error('Could not resolve the song: %s', e)
+            return None
+
+    def _drain_queue(self, window):
+        """Takes songs off the queue for up to window seconds (or just what's already there
+        if window is 0). Stops the player if it finds the shutdown marker.
+
+        Returns a list of the songs it took
+        """
+        items = []
+        deadline = monotonic() + window
+        while True:
+            try:
+                item = self.song_queue.get(True, max(0, deadline - monotonic())) if window else \
+                    self.song_queue.get_nowait()
+            except Empty:
+                return items
+            if item is None:
+                self.running = False
+                return items
+            items.append(item)
+
+    def _play_item(self, item, device_id):
+        """Plays one queued song and waits for it to finish"""
+        uri, start_minute, start_second, duration, arrival = item
+        uri = self._wait_for_uri(uri)
+        if not uri:
+            logging.info('Nothing to play for this one')
+            return
 
+        logging.info('Playing %s at %d:%d duration %d', uri, start_minute, start_second, duration)
+        t = self._play_song(uri, start_minute, start_second, duration, device_id=device_id, arrival=arrival)
+        with self._current_lock:
+            self.current_thread = t
+        # Someone may have arrived while we were getting ready
+        self._apply_busy_limit()
+        if not self.running:
+            t.preempt()
+        logging.info('Waiting for song to end...')
+        t.join()
+        with self._current_lock:
+            self.current_thread = None
 
     def player_main(self):
         logging.info('Starting music player')
-        while True:
-            uri, start_minute, start_second, duration = self.song_queue.get(True)
+        while self.running:
+            item = self.song_queue.get(True)
+            if item is None:
+                break
             logging.info('Found a song on the queue!')
-            logging.info('Playing %s at %d:%d duration %d', uri, start_minute, start_second, duration)
-            current_playback = self.save_current_playback()
-            t = self._play_song(uri, start_minute, start_second, duration)
-            logging.info('Waiting for song to end...')
-            t.join()
+
+            # Players on the same account take turns, since the account only plays on one
+            # device at a time and one player's save would fade out the other's song
+            if not self.account_lock.acquire(blocking=False):
+                logging.info('Waiting for another device on this account to finish')
+                self.account_lock.acquire()
+            try:
+                self._play_cycle(item)
+            finally:
+                self.account_lock.release()
+        logging.info('Music player stopped')
+
+    def _play_cycle(self, item):
+        """Saves the current music, plays a queued song (and in coalescing mode anyone else's
+        that comes in meanwhile), then restores the music
+        """
+        self.pending = [item]
+        api_calls = metrics.get('spotify_api_calls')
+        window_ends = monotonic() + (self.coalesce_window or 0)
+
+        # Check the device while the current music fades out, and play as soon as
+        # both that and the URI are ready
+        device_future = self.executor.submit(self._prepare_device)
+        started = monotonic()
+        try:
+            self.save_current_playback()
+        except Exception as e:
+            logging.error('Could not save the current playback: %s', e)
+        metrics.observe('save_playback', monotonic() - started)
+        try:
+            device_id = device_future.result()
+        except Exception as e:
+            logging.error('Could not check device %s: %s. Playing on the active device instead',
+                          self.device_id, e)
+            device_id = None
+
+        # In coalescing mode, anyone else who came in while we were saving plays back to
+        # back with this one between one save and one restore. Only wait for whatever is
+        # left of the window once the save is done.
+        if self.coalesce_window is not None:
+            self.pending.extend(self._drain_queue(max(0, window_ends - monotonic())))
+            logging.info('Playing %d songs back to back', len(self.pending))
+        arrivals = len(self.pending)
+        for queued in self.pending:
+            if queued[4]:
+                queued[4].mark('song_queue_wait')
+
+        while self.pending and self.running:
+            try:
+                self._play_item(self.pending.pop(0), device_id)
+            except Exception as e:
+                logging.error('Could not play the song: %s', e)
+            if self.coalesce_window is not None and self.running:
+                more = self._drain_queue(0)
+                arrivals += len(more)
+                self.pending.extend(more)
+        self.pending = []
+
+        started = monotonic()
+        try:
             self.restore_playback()
-            logging.info('Song over... waiting for the next song on the queue')
+        except Exception as e:
+            logging.error('Could not restore playback: %s', e)
+        metrics.observe('restore_playback', monotonic() - started)
+        metrics.observe('api_calls_per_arrival', (metrics.get('spotify_api_calls') - api_calls) / float(arrivals),
+                        buckets=COUNT_BUCKETS)
+        logging.info('Song over... waiting for the next song on the queue')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,201 @@
+"""Gets ready for people before they show up.
+
+Most people arrive around the same time every day. The predictor learns each owner's
+usual window from the arrival log (separately for weekdays and weekends), and a little
+before it opens, warms everything their arrival needs: the song's Spotify URI, their
+device records in the MAC index, and the Spotify device their song will play on.
+
+Run this module on its own for a report on the arrival log, with each owner's window and
+the gaps between arrivals, for tuning the cooldowns and --coalesce.
+
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from threading import Event, Thread
+import logging
+
+from . import data
+from .metrics import StageTimes, percentile
+
+DEFAULT_LEAD_MINUTES = 10
+DEFAULT_HISTORY_DAYS = 28
+# How many days someone has to have come in on before we guess at their window
+DEFAULT_MIN_DAYS = 3
+CHECK_INTERVAL = 60
+# The share of days the window covers, from this percentile to 100 minus it
+WINDOW_PERCENTILE = 10
+
+
+def _minute_of_day(when):
+    return when.hour * 60 + when.minute
+
+
+def usual_windows(arrivals, min_days=DEFAULT_MIN_DAYS):
+    """Works out when each owner usually arrives.
+
+    Args:
+        arrivals - (owner_name, arrived_at) pairs
+        min_days - Skip owners seen on fewer days than this
+
+    Returns a dict of (owner_name, is_weekday) -> (first_minute, last_minute), in minutes
+    after midnight, covering most of the days they came in
+    """
+    firsts = {}
+    for owner, arrived_at in arrivals:
+        key = (owner, arrived_at.date())
+        minute = _minute_of_day(arrived_at)
+        if key not in firsts or minute < firsts[key]:
+            firsts[key] = minute
+
+    minutes = defaultdict(list)
+    for (owner, day), minute in firsts.items():
+        minutes[(owner, day.weekday() < 5)].append(minute)
+
+    windows = {}
+    for key, values in minutes.items():
+        if len(values) < min_days:
+            continue
+        windows[key] = (percentile(values, WINDOW_PERCENTILE),
+                        percentile(values, 100 - WINDOW_PERCENTILE))
+    return windows
+
+
+class ArrivalPredictor(Thread):
+    """Warms up owners' arrivals ahead of their usual windows."""
+    def __init__(self, controller, lead_minutes=DEFAULT_LEAD_MINUTES, history_days=DEFAULT_HISTORY_DAYS,
+                 min_days=DEFAULT_MIN_DAYS):
+        """Constructor
+        Args
+            controller - The EntranceController to warm up
+            lead_minutes - How long before a window opens to warm it
+            history_days - How far back in the arrival log to look
+            min_days - How many days someone has to have come in on to get a window
+        """
+        super().__init__(name='predictor', daemon=True)
+        self.controller = controller
+        self.lead_minutes = lead_minutes
+        self.history_days = history_days
+        self.min_days = min_days
+        self.windows = {}
+        self._loaded_on = None
+        # Owner -> the day they were last warmed for
+        self._warmed = {}
+        self._stopped = Event()
+
+    def load(self, now=None):
+        """Rebuilds the windows from the arrival log"""
+        now = now or datetime.now()
+        arrivals = data.get_arrivals(since=now - timedelta(days=self.history_days))
+        self.windows = usual_windows(((a.owner_name, a.arrived_at) for a in arrivals if a.outcome != 'no_song'),
+                                     self.min_days)
+        self._loaded_on = now.date()
+        logging.info('Predicting arrivals for %d owners from %d logged arrivals', len(self.windows), len(arrivals))
+
+    def due(self, now=None):
+        """Gets the owners whose window opens within the lead time (or is open now) and who
+        haven't been warmed for today yet
+        """
+        now = now or datetime.now()
+        minute = _minute_of_day(now)
+        weekday = now.weekday() < 5
+        owners = []
+        for (owner, is_weekday), (first, last) in self.windows.items():
+            if is_weekday != weekday or self._warmed.get(owner) == now.date():
+                continue
+            if first - self.lead_minutes <= minute <= last:
+                owners.append(owner)
+        return owners
+
+    def warm(self, owner):
+        """Warms everything an owner's arrival needs"""
+        # Looking at the index rebuilds it first if it's stale
+        records = [r for r in data.device_index.records() if r.owner and r.owner.name == owner]
+        if not records:
+            return
+        logging.info('%s usually gets here soon. Warming up', owner)
+        self.controller.search_cache.prewarm(records[0].owner.song, workers=1)
+        # An account only has one active device, so waking a second device on the same
+        # account would put the first one back to sleep
+        accounts = set()
+        for player in self.controller.players_for(None, owner):
+            if player.username not in accounts:
+                accounts.add(player.username)
+                player.warm_device()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            now = datetime.now()
+            try:
+                if self._loaded_on != now.date():
+                    self.load(now)
+                for owner in self.due(now):
+                    self._warmed[owner] = now.date()
+                    self.warm(owner)
+            except Exception as e:
+                logging.exception('Error predicting arrivals: %s', e)
+            self._stopped.wait(CHECK_INTERVAL)
+
+
+def _format_minute(minute):
+    return '{:02d}:{:02d}'.format(minute // 60, minute % 60)
+
+
+def report(arrivals, min_days=DEFAULT_MIN_DAYS):
+    """Summarizes logged arrivals. Returns lines to print."""
+    lines = ['{} arrivals logged'.format(len(arrivals))]
+    if not arrivals:
+        return lines
+
+    outcomes = defaultdict(int)
+    for arrival in arrivals:
+        outcomes[arrival.outcome] += 1
+    lines.append(', '.join('{} {}'.format(count, outcome) for outcome, count in sorted(outcomes.items())))
+
+    times = StageTimes()
+    last_by_owner = {}
+    previous = None
+    for arrival in arrivals:
+        if arrival.latency_ms is not None:
+            times.record('door_to_music', arrival.latency_ms / 1000.0)
+        # How soon people come back, for --owner-cooldown
+        last = last_by_owner.get(arrival.owner_name)
+        if last:
+            times.record('owner_return', (arrival.arrived_at - last).total_seconds())
+        last_by_owner[arrival.owner_name] = arrival.arrived_at
+        # How close together different people come in, for --coalesce
+        if previous and previous.owner_name != arrival.owner_name:
+            times.record('next_person', (arrival.arrived_at - previous.arrived_at).total_seconds())
+        previous = arrival
+
+    lines.append('')
+    for name, values in sorted(times.samples.items()):
+        lines.append('  {:<14} n={:<7} p10={:9.1f} p50={:9.1f} p90={:9.1f} seconds'.format(
+            name, len(values), *(percentile(values, p) for p in (10, 50, 90))))
+
+    lines.append('')
+    lines.append('Usual arrival windows (owners seen on at least {} days):'.format(min_days))
+    windows = usual_windows(((a.owner_name, a.arrived_at) for a in arrivals if a.outcome != 'no_song'), min_days)
+    for (owner, is_weekday), (first, last) in sorted(windows.items()):
+        lines.append('  {:<24} {:<8} {} - {}'.format(owner, 'weekdays' if is_weekday else 'weekends',
+                                                     _format_minute(first), _format_minute(last)))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarizes the arrival log')
+    parser.add_argument('--days', dest='days', action='store', default=DEFAULT_HISTORY_DAYS, type=int,
+                        help='How many days back to look')
+    parser.add_argument('--min-days', dest='min_days', action='store', default=DEFAULT_MIN_DAYS, type=int)
+    args = parser.parse_args()
+
+    data.migrate()
+    arrivals = data.get_arrivals(since=datetime.now() - timedelta(days=args.days))
+    for line in report(arrivals, args.min_days):
+        print(line)
+
+if __name__ == '__main__':
+    main()
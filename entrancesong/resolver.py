@@ -0,0 +1,102 @@
+"""Worker pool that takes DHCP requests off the capture thread.
+
+The capture thread only puts requests on a bounded queue. Worker threads do the slow
+parts (database lookups, Spotify searches) so capture never waits on them.
+
+"""
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+import logging
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUED = 256
+
+# Log a warning every time this many more requests have been dropped
+DROP_LOG_INTERVAL = 100
+
+
+class ResolverStats(object):
+    """Counters for a ResolverPool"""
+    def __init__(self):
+        self._lock = Lock()
+        self.submitted = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def __str__(self):
+        return 'submitted: {}, processed: {}, dropped: {}, errors: {}'.format(
+            self.submitted, self.processed, self.dropped, self.errors)
+
+
+class ResolverPool(object):
+    """A bounded queue drained by a pool of worker threads.
+
+    When the queue is full new requests are dropped (and counted) instead of blocking
+    the caller.
+    """
+    def __init__(self, handler, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED):
+        """Constructor
+        Args
+            handler - Called with each submitted item on a worker thread
+            workers - The number of worker threads
+            max_queued - How many items can wait on the queue before new ones are dropped
+        """
+        self.handler = handler
+        self.num_workers = max(1, workers)
+        self.queue = Queue(maxsize=max_queued)
+        self.stats = ResolverStats()
+        self.threads = []
+        self.running = False
+
+    def start(self):
+        """Starts the worker threads"""
+        self.running = True
+        for i in range(self.num_workers):
+            t = Thread(target=self._worker, name='resolver-{}'.format(i), daemon=True)
+            t.start()
+            self.threads.append(t)
+        logging.info('Started %d resolver workers (queue size %d)', self.num_workers, self.queue.maxsize)
+
+    def submit(self, item):
+        """Queues an item without blocking. Returns False if it was dropped."""
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.stats.incr('dropped')
+            if self.stats.dropped % DROP_LOG_INTERVAL == 1:
+                logging.warning('Resolver queue is full, dropping requests (%s)', self.stats)
+            return False
+        self.stats.incr('submitted')
+        return True
+
+    def depth(self):
+        """Returns the number of items waiting on the queue"""
+        return self.queue.qsize()
+
+    def stop(self, timeout=None):
+        """Stops the workers once they finish what they're doing"""
+        self.running = False
+        for t in self.threads:
+            t.join(timeout)
+        self.threads = []
+        logging.info('Resolver workers stopped (%s)', self.stats)
+
+    def _worker(self):
+        while self.running:
+            try:
+                item = self.queue.get(True, 0.5)
+            except Empty:
+                continue
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.stats.incr('errors')
+                logging.exception('Error handling %s: %s', item, e)
+            finally:
+                self.stats.incr('processed')
+                self.queue.task_done()
@@ -0,0 +1,113 @@
+"""Persistent cache of Spotify search results.
+
+A song's artist and title always search to the same track, so we only ask Spotify once
+and keep the URI in the search_result table (and in memory) until it expires. The copy in
+memory is reloaded when the database changes, so deleting rows forces a new search without
+a restart.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+import logging
+
+from . import data
+from .metrics import metrics
+
+# How long a cached search result is good for, in hours
+DEFAULT_TTL_HOURS = 24 * 30
+PREWARM_WORKERS = 4
+
+
+class SearchCache(object):
+    """Looks up Spotify URIs by (artist, title), searching Spotify only on a miss."""
+    def __init__(self, player, ttl_hours=DEFAULT_TTL_HOURS):
+        """Constructor
+        Args
+            player - The MusicPlayer used to search on a miss
+            ttl_hours - How long cached results are used before searching again
+        """
+        self.player = player
+        self.ttl = timedelta(hours=ttl_hours)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        data.create_search_result_table()
+        self._mtime = None
+        self._load()
+        logging.info('Loaded %d cached search results', len(self._results))
+
+    def _load(self):
+        """Reads every cached result from the database"""
+        mtime = data.db_mtime()
+        results = data.get_search_results()
+        with self._lock:
+            self._results = results
+            self._mtime = mtime
+
+    def get(self, artist, title):
+        """Gets a cached (uri, name) for a song, or None if it isn't cached or has expired"""
+        if data.db_mtime() != self._mtime:
+            self._load()
+            logging.debug('Reloaded %d cached search results', len(self._results))
+        result = self._results.get((artist, title))
+        if not result:
+            return None
+        if datetime.now() - result.resolved_at > self.ttl:
+            return None
+        return result.uri, result.name
+
+    def resolve(self, artist, title):
+        """Gets the (uri, name) for a song, searching Spotify if it isn't cached.
+
+        Returns (None, None) if the search didn't find anything.
+        """
+        cached = self.get(artist, title)
+        if cached:
+            self.hits += 1
+            logging.info('Using cached search result %s for %s - %s', cached[0], artist, title)
+            return cached
+
+        self.misses += 1
+        started = monotonic()
+        uri, name = self.player.search(artist, title)
+        metrics.observe('spotify_search', monotonic() - started)
+        if uri:
+            now = datetime.now()
+            with self._lock:
+                self._results[(artist, title)] = data.CachedSearch(uri, name, now, None)
+                current = data.db_mtime() == self._mtime
+            data.save_search_result(artist, title, uri, name, now)
+            if current:
+                # Our own write is already in memory, so don't reload everything for it
+                with self._lock:
+                    self._mtime = data.db_mtime()
+        return uri, name
+
+    def prewarm(self, songs=None, workers=PREWARM_WORKERS):
+        """Resolves every song that isn't already cached, several at a time.
+
+        Args:
+            songs - The songs to resolve (anything with artist and title), or None for every
+                song in the database
+            workers - How many searches to run at once
+        """
+        if songs is None:
+            songs = data.get_all_songs()
+        pending = {(s.artist, s.title) for s in songs if s.artist and s.title}
+        pending = [key for key in pending if not self.get(*key)]
+        if not pending:
+            return
+        logging.info('Prewarming search cache with %d songs', len(pending))
+
+        def _resolve(key):
+            try:
+                self.resolve(*key)
+            except Exception as e:
+                logging.warning('Could not prewarm %s - %s: %s', key[0], key[1], e)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_resolve, pending))
+        logging.info('Search cache prewarmed')
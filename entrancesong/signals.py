@@ -0,0 +1,195 @@
+"""Arrival signals besides DHCP REQUEST.
+
+Phones that rejoin with a cached lease often announce themselves with a gratuitous ARP or
+an IPv6 duplicate address check long before (or instead of) a fresh DHCP REQUEST, and a
+DHCP DISCOVER comes a round trip before the REQUEST does. A SignalDetector turns frames
+into Detections for whichever of these signals are turned on.
+
+"""
+from collections import namedtuple
+from time import monotonic
+import socket
+
+from .capture import (DHCP_BPF_FILTER, DHCP_DISCOVER, DHCP_REQUEST, ETH_HEADER_LEN, ETH_P_IP, format_mac,
+                      parse_dhcp_frame)
+
+SIGNAL_DHCP_REQUEST = 'dhcp-request'
+SIGNAL_DHCP_DISCOVER = 'dhcp-discover'
+SIGNAL_ARP = 'arp'
+SIGNAL_NDP = 'ndp'
+SIGNALS = (SIGNAL_DHCP_REQUEST, SIGNAL_DHCP_DISCOVER, SIGNAL_ARP, SIGNAL_NDP)
+
+# Something on the network that says a device just showed up. hostname and requested_addr
+# are None when the signal doesn't carry them.
+Detection = namedtuple('Detection', ['mac_addr', 'signal', 'hostname', 'requested_addr', 'received_at', 'iface'])
+
+ETH_P_ALL = 0x0003
+ETH_P_ARP = 0x0806
+ETH_P_IPV6 = 0x86dd
+
+ARP_LEN = 28
+IPV6_HEADER_LEN = 40
+IPPROTO_ICMPV6 = 58
+ICMPV6_NEIGHBOR_SOLICITATION = 135
+UNSPECIFIED_IPV6 = bytes(16)
+UNSPECIFIED_IPV4 = bytes(4)
+
+# Classic BPF that lets through DHCP (like capture.DHCP_BPF_FILTER), every ARP packet, and
+# IPv6 neighbor solicitations. Each entry is (code, jt, jf, k).
+SIGNALS_BPF_FILTER = [
+    (0x28, 0, 0, 0x0000000c),   # 0  ldh [12]              ethertype
+    (0x15, 18, 0, 0x00000806),  # 1  jeq #0x806            ARP, accept
+    (0x15, 0, 4, 0x000086dd),   # 2  jeq #0x86dd           IPv6, or go check for IPv4
+    (0x30, 0, 0, 0x00000014),   # 3  ldb [20]              IPv6 next header
+    (0x15, 0, 14, 0x0000003a),  # 4  jeq #58               ICMPv6 or drop
+    (0x30, 0, 0, 0x00000036),   # 5  ldb [54]              ICMPv6 type
+    (0x15, 13, 12, 0x00000087), # 6  jeq #135              neighbor solicitation, accept or drop
+    (0x15, 0, 11, 0x00000800),  # 7  jeq #0x800            IPv4 or drop
+    (0x30, 0, 0, 0x00000017),   # 8  ldb [23]              IP protocol
+    (0x15, 0, 9, 0x00000011),   # 9  jeq #17               UDP or drop
+    (0x28, 0, 0, 0x00000014),   # 10 ldh [20]              fragment offset
+    (0x45, 7, 0, 0x00001fff),   # 11 jset #0x1fff          drop fragments
+    (0xb1, 0, 0, 0x0000000e),   # 12 ldxb 4*([14]&0xf)     IP header length
+    (0x48, 0, 0, 0x0000000e),   # 13 ldh [x + 14]          source port
+    (0x15, 5, 0, 0x00000043),   # 14 jeq #67
+    (0x15, 4, 0, 0x00000044),   # 15 jeq #68
+    (0x48, 0, 0, 0x00000010),   # 16 ldh [x + 16]          destination port
+    (0x15, 2, 0, 0x00000043),   # 17 jeq #67
+    (0x15, 1, 0, 0x00000044),   # 18 jeq #68
+    (0x06, 0, 0, 0x00000000),   # 19 ret #0                drop
+    (0x06, 0, 0, 0x00040000),   # 20 ret #262144           accept
+]
+
+# The same thing for scapy, a piece per signal
+CAPTURE_FILTERS = {
+    SIGNAL_DHCP_REQUEST: 'udp and (port 67 or 68)',
+    SIGNAL_DHCP_DISCOVER: 'udp and (port 67 or 68)',
+    SIGNAL_ARP: 'arp',
+    SIGNAL_NDP: 'icmp6 and ip6[40] == 135',
+}
+
+
+def _ethertype(frame):
+    return (frame[12] << 8) | frame[13]
+
+
+def parse_arp_frame(frame, iface=None):
+    """Parses an ARP frame, but only a gratuitous ARP or an ARP probe. Those are what a device
+    sends when it joins a network; ordinary ARP requests keep coming the whole time it's here.
+
+    Returns a Detection, or None
+    """
+    if len(frame) < ETH_HEADER_LEN + ARP_LEN or _ethertype(frame) != ETH_P_ARP:
+        return None
+    arp = ETH_HEADER_LEN
+    sender_addr = frame[arp + 14:arp + 18]
+    target_addr = frame[arp + 24:arp + 28]
+    if sender_addr == UNSPECIFIED_IPV4:
+        # A probe, checking nobody else has the address it's about to use
+        addr = target_addr
+    elif sender_addr == target_addr:
+        # An announcement
+        addr = sender_addr
+    else:
+        return None
+    return Detection(format_mac(frame[arp + 8:arp + 14]), SIGNAL_ARP, None, '%d.%d.%d.%d' % tuple(addr),
+                     monotonic(), iface)
+
+
+def parse_ndp_frame(frame, iface=None):
+    """Parses an IPv6 neighbor solicitation, but only a duplicate address check (which comes
+    from the unspecified address). Like gratuitous ARPs, those are sent when joining.
+
+    Returns a Detection, or None
+    """
+    ip6 = ETH_HEADER_LEN
+    icmp = ip6 + IPV6_HEADER_LEN
+    if len(frame) < icmp + 24 or _ethertype(frame) != ETH_P_IPV6:
+        return None
+    if frame[ip6 + 6] != IPPROTO_ICMPV6 or frame[icmp] != ICMPV6_NEIGHBOR_SOLICITATION:
+        return None
+    if frame[ip6 + 8:ip6 + 24] != UNSPECIFIED_IPV6:
+        return None
+    addr = socket.inet_ntop(socket.AF_INET6, bytes(frame[icmp + 8:icmp + 24]))
+    return Detection(format_mac(frame[6:12]), SIGNAL_NDP, None, addr, monotonic(), iface)
+
+
+def detection_from_dhcp(request):
+    """Turns a DhcpRequest into a Detection, or None if it's not a DISCOVER or a REQUEST"""
+    if request.message_type == DHCP_REQUEST:
+        signal = SIGNAL_DHCP_REQUEST
+    elif request.message_type == DHCP_DISCOVER:
+        signal = SIGNAL_DHCP_DISCOVER
+    else:
+        return None
+    return Detection(request.mac_addr, signal, request.hostname, request.requested_addr, request.received_at,
+                     request.iface)
+
+
+def parse_dhcp_signal(frame, iface=None):
+    """Parses a DHCP frame into a Detection, or None"""
+    request = parse_dhcp_frame(frame, iface)
+    return detection_from_dhcp(request) if request else None
+
+
+# Ethertype -> parser that returns a Detection or None
+PARSERS = {
+    ETH_P_IP: parse_dhcp_signal,
+    ETH_P_ARP: parse_arp_frame,
+    ETH_P_IPV6: parse_ndp_frame,
+}
+
+
+class SignalDetector(object):
+    """Picks the signals we act on out of captured frames."""
+    def __init__(self, signals=(SIGNAL_DHCP_REQUEST,)):
+        """Constructor
+        Args
+            signals - The names of the signals to detect
+        """
+        unknown = set(signals) - set(SIGNALS)
+        if unknown:
+            raise ValueError('Unknown signals: %s' % ', '.join(sorted(unknown)))
+        self.signals = frozenset(signals)
+        self.parsers = dict(PARSERS)
+
+    @property
+    def dhcp_only(self):
+        """True if every signal we want is a DHCP packet"""
+        return self.signals <= {SIGNAL_DHCP_REQUEST, SIGNAL_DHCP_DISCOVER}
+
+    @property
+    def protocol(self):
+        """The ethertype to open a raw socket for"""
+        return ETH_P_IP if self.dhcp_only else ETH_P_ALL
+
+    @property
+    def bpf_program(self):
+        """The classic BPF program for a raw socket"""
+        return DHCP_BPF_FILTER if self.dhcp_only else SIGNALS_BPF_FILTER
+
+    @property
+    def capture_filter(self):
+        """The filter to give scapy"""
+        pieces = []
+        for signal in SIGNALS:
+            if signal in self.signals and CAPTURE_FILTERS[signal] not in pieces:
+                pieces.append(CAPTURE_FILTERS[signal])
+        return ' or '.join('({})'.format(piece) for piece in pieces)
+
+    def detect(self, frame, iface=None):
+        """Gets a Detection out of an Ethernet frame, or None if it isn't a signal we want"""
+        if len(frame) < ETH_HEADER_LEN:
+            return None
+        parse = self.parsers.get(_ethertype(frame))
+        detection = parse(frame, iface) if parse else None
+        if detection and detection.signal in self.signals:
+            return detection
+        return None
+
+    def from_dhcp(self, request):
+        """Turns a DhcpRequest into a Detection, or None if it isn't a signal we want"""
+        detection = detection_from_dhcp(request)
+        if detection and detection.signal in self.signals:
+            return detection
+        return None
@@ -0,0 +1,79 @@
+"""Zones: which Spotify devices play an arrival's song.
+
+A zone maps a capture interface or a device owner to one or more Spotify devices, so
+someone coming in on the guest Wi-Fi gets their song in the lobby, or the boss gets theirs
+in every room. Each device gets its own MusicPlayer, so they all save, fade, play and
+restore at the same time, each with its own saved playback.
+
+A Spotify account only plays on one device at a time, so devices that should play at once
+need to be on different accounts. Give a device's account as DEVICE@ACCOUNT, where ACCOUNT
+is the user name its token is cached under (.cache-ACCOUNT).
+
+"""
+from collections import namedtuple, OrderedDict
+
+ZONE_IFACE = 'iface'
+ZONE_OWNER = 'owner'
+
+# A device to play on, and the account it belongs to (None for the default account)
+ZoneTarget = namedtuple('ZoneTarget', ['device_id', 'account'])
+
+
+def parse_zone(spec):
+    """Parses a zone like 'iface:wlan-guest=DEVICE1,DEVICE2@lobby' or 'owner:Austin=DEVICE'.
+
+    Returns a tuple of (kind, key, [ZoneTarget, ...]). Raises ValueError if it doesn't parse.
+    """
+    if '=' not in spec or ':' not in spec.split('=', 1)[0]:
+        raise ValueError('Zones look like iface:NAME=DEVICE[,DEVICE...] or owner:NAME=DEVICE[,DEVICE...]')
+    match, devices = spec.split('=', 1)
+    kind, key = match.split(':', 1)
+    if kind not in (ZONE_IFACE, ZONE_OWNER):
+        raise ValueError('Zones match on iface or owner, not %s' % kind)
+
+    targets = []
+    for device in devices.split(','):
+        device_id, _, account = device.strip().partition('@')
+        if not device_id:
+            raise ValueError('Zone %s has an empty device ID' % match)
+        targets.append(ZoneTarget(device_id, account or None))
+    return kind, key, targets
+
+
+class ZoneMap(object):
+    """Looks up the devices an arrival should play on."""
+    def __init__(self, zones=()):
+        """Constructor
+        Args
+            zones - (kind, key, targets) tuples, like parse_zone returns
+        """
+        self.by_iface = {}
+        self.by_owner = {}
+        for kind, key, targets in zones:
+            self.add(kind, key, targets)
+
+    def add(self, kind, key, targets):
+        """Adds devices to the zone for an interface or owner"""
+        zones = self.by_iface if kind == ZONE_IFACE else self.by_owner
+        zones.setdefault(key, []).extend(targets)
+
+    def targets(self, iface=None, owner=None):
+        """Gets the devices for an arrival on an interface by an owner, without repeats.
+        Returns an empty list if no zone matches.
+        """
+        found = OrderedDict()
+        for target in self.by_iface.get(iface, []) + self.by_owner.get(owner, []):
+            found[target] = True
+        return list(found)
+
+    def all_targets(self):
+        """Gets every device in every zone, without repeats"""
+        found = OrderedDict()
+        for zones in (self.by_iface, self.by_owner):
+            for targets in zones.values():
+                for target in targets:
+                    found[target] = True
+        return list(found)
+
+    def __bool__(self):
+        return bool(self.by_iface or self.by_owner)